@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from concurrent import futures
 from functools import wraps
 from multiprocessing import Process
@@ -6,21 +6,31 @@ from ipaddress import ip_address
 import inquirer
 import sys
 
-from flask import Flask, flash, redirect, render_template, request, url_for, session
+from flask import Flask, flash, g, jsonify, redirect, render_template, request, url_for, session
 from flask_login import (LoginManager, current_user, login_required,
                          login_user, logout_user)
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
 
+from cache import fragments, users
+from channels import SERVER_OPTIONS, channels
 from config import *
 from forms import LoginForm, PostForm, RegisterForm, CommentForm
-from models import Comment, Post, User, Vote, db
+from models import (Comment, Post, User, Vote, cached_user, cached_users, db, migrate_schema,
+                    recount_votes)
 from p2p import P2PNode
+from passwords import Overloaded, hasher
+from search import create_search_index, rebuild_search_index, search_posts
 from gossip import P2PSyncServer
 
+import config
 import grpc
+import metrics
 import p2psync_pb2 as pb2
 import p2psync_pb2_grpc as pb2_grpc
 
-CONFIG_FILE = 'config.py'
+# Fork the password hashing processes while this is the only thread
+hasher.start()
 
 def validate_ip(addr):
     """Validates an IP address without noisy ValueError"""
@@ -32,41 +42,61 @@ def validate_ip(addr):
         raise inquirer.errors.ValidationError("", reason=f"Your input is not an IPV4 or IPV6 address.")
     return True
 
-addr, port = None, None
-while True:
-    questions = [inquirer.Text('ip', message="What is the IP address of another node in the network?",
-                validate=lambda _, x: validate_ip(x)),
-                inquirer.Text('port', message="What is the port you want to use to connect to the network?")]
-
-    answers = inquirer.prompt(questions, raise_keyboard_interrupt=True)
-    addr, port = answers['ip'], answers['port']
-
-    # If other node is 'None' provided, then break
-    if addr == 'None':
-        addr, port = None, None
-        break
-
-    # Check to see if the IP address and port represent an active P2PNode
-    stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{addr}:{port}'))
+def ask_for_peer():
+    """Prompts for an active node to join until one answers, or 'None' to start a new network"""
+    while True:
+        questions = [inquirer.Text('ip', message="What is the IP address of another node in the network?",
+                    validate=lambda _, x: validate_ip(x)),
+                    inquirer.Text('port', message="What is the port you want to use to connect to the network?")]
+
+        answers = inquirer.prompt(questions, raise_keyboard_interrupt=True)
+        addr, port = answers['ip'], answers['port']
+
+        # If other node is 'None' provided, then start a new network
+        if addr == 'None':
+            return None, None
+
+        # Check to see if the IP address and port represent an active P2PNode
+        try:
+            channels.stub(addr, port).Connect(pb2.Peer(host=HOST, port=str(PORT)))
+            return addr, port
+        except grpc._channel._InactiveRpcError as e:
+            channels.close(addr, port)
+            if e.code() == grpc.StatusCode.ALREADY_EXISTS:
+                sys.exit(f'Error: {e.details()}')  # Our own port is the problem, not the node we asked
+            print('Error: The IP address and port you provided does not refer to an active node.')
+
+# PEER in config.py answers the prompt ahead of time, e.g. for scripts that import the app
+if PEER == 'None':
+    addr, port = None, None
+elif PEER:
+    addr, port = PEER.rsplit(':', 1)
     try:
-        stub.Connect(pb2.Peer(host=HOST, port=str(PORT)))
-        break
-    except grpc._channel._InactiveRpcError:
-        print('Error: The IP address and port you provided does not refer to an active node.')
+        channels.stub(addr, port).Connect(pb2.Peer(host=HOST, port=str(PORT)))  # Announces us, as the prompt does
+    except grpc._channel._InactiveRpcError as e:
+        sys.exit(f'Error: {e.details()}')
+else:
+    addr, port = ask_for_peer()
 
-# Initialize the Flask application
+# Initialize the Flask application from the same settings as the rest of the node
 app = Flask(__name__)
-app.config.from_pyfile(CONFIG_FILE)
+app.config.from_object(config)
 
 db.init_app(app)
 with app.app_context():
     db.create_all()  # Create the database tables for our data models, if they do not exist
+    migrate_schema()  # Add the columns and indexes that tables made by older versions lack
+    create_search_index()  # Full-text index over posts, built from existing posts the first time
+    if METRICS_ENABLED:
+        metrics.init_app(app, db)
 
 # Initialize the P2P node
-node = P2PNode(HOST, PORT, addr, port, db.session, app.app_context())
+node = P2PNode(HOST, PORT, addr, port, app.app_context())
+if METRICS_ENABLED:
+    metrics.watch_replication(node.gossip_protocol.replication_status)
 
 # Setup server infra for the P2PNode
-server = grpc.server(futures.ThreadPoolExecutor(max_workers=10)) # 10 threads
+server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS) # 10 threads
 pb2_grpc.add_P2PSyncServicer_to_server(P2PSyncServer(), server) # Add service to server
 server.add_insecure_port(f'{HOST}:{PORT}')
 server.start()
@@ -77,36 +107,118 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+# Renders a post card or comment through the fragment cache. Cached fragments are
+# shared by every viewer of the same variant (guest, member or the author), and the
+# current user's vote highlighting and CSRF token are filled in afterwards, at markers
+# that start with '<', which user-written text can never contain once it is escaped.
+@app.template_global()
+def fragment(kind, content, is_upvote=None):
+    if not current_user.is_authenticated:
+        variant = 'guest'
+    elif content.author_id == current_user.id:
+        variant = 'author'
+    else:
+        variant = 'member'
+
+    html = fragments.get_or_render(kind, content.id, variant, lambda: render_template(
+        f'fragments/{kind}.html', content=content, variant=variant, form=CommentForm(formdata=None)))
+    if variant != 'guest':
+        html = html.replace('<!--upvote-class-->', 'btn-success' if is_upvote == True else 'btn-secondary') \
+                   .replace('<!--downvote-class-->', 'btn-danger' if is_upvote == False else 'btn-secondary') \
+                   .replace('<!--csrf-token-->', generate_csrf())
+    return Markup(html)
+
+
+# Author names for a page are loaded together before it is rendered, from the user cache
+# and the rest in one query, and kept in g.authors, so templates never look up users one
+# at a time through the author relationship of each post or comment
+def load_authors(user_ids):
+    g.authors = cached_users(user_ids)
+
+
+@app.template_global()
+def username(user_id):
+    user = g.get('authors', {}).get(user_id) or cached_user(user_id)
+    return user.username if user is not None else ''
+
+
+# Recompute the denormalized vote counters from the vote table: `flask recount-votes`
+@app.cli.command('recount-votes')
+def recount_votes_command():
+    recount_votes()
+    print('Vote counters recomputed.')
+
+
+# Re-index every post for search: `flask rebuild-search-index`
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    rebuild_search_index()
+    print('Search index rebuilt.')
+
+
+# Time windows for the "top" sort of the homepage
+TOP_WINDOWS = {
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+    'month': timedelta(days=30),
+    'year': timedelta(days=365),
+}
+
+
+# Read-your-writes: the commit number of the user's last write is kept in their session
+def remember_write(commit):
+    session['last_commit'] = max(session.get('last_commit', 0), commit)
+
+
+# The wrapper function for pages that only read. Their queries go to the read replica,
+# unless it has not yet applied the current user's last write, so users always see
+# their own posts, comments and votes.
+def read_only(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        g.read_replica = AUTO_READ_ON_SLAVE and node.gossip_protocol.replica_caught_up(session.get('last_commit', 0))
+        return func(*args, **kwargs)
+    return wrapper
+
+
 # Route for the homepage, which shows all the posts
 @app.route('/', methods=['GET', 'POST'])
+@read_only
 def index():
     query = request.args.get('query')
-    posts = [{'post': x} for x in Post.query.filter_by(deleted=False).order_by(Post.date_posted.desc()).all()]
+    sort = request.args.get('sort', 'new')
+    window = request.args.get('t')
     if query:
-        posts = [{'post': x} for x in Post.query.filter(Post.title.contains(query) | Post.content.contains(query)).filter_by(deleted=False).order_by(Post.date_posted.desc()).all()]
+        page, next_cursor = search_posts(query, request.args.get('after'), POSTS_PER_PAGE)
+    else:
+        feed = Post.query.filter_by(deleted=False)
+        if sort == 'top' and window in TOP_WINDOWS:
+            feed = feed.filter(Post.date_posted >= datetime.utcnow() - TOP_WINDOWS[window])
+        page, next_cursor = Post.keyset_page(feed, request.args.get('after'), POSTS_PER_PAGE, sort)
+    posts = [{'post': x} for x in page]
+    load_authors({post.author_id for post in page})
 
     # Logic to properly display user upvotes/downvotes
     if current_user.is_authenticated:
-        user_id = current_user.id
+        my_votes = Vote.post_votes_by(current_user.id, [post['post'].id for post in posts])
         for post in posts:
-            content = post['post']
-            vote_query = content.votes.filter_by(
-                user_id=user_id, post_id=content.id
-            ).all()
-            post['is_upvote'] = vote_query[0].is_upvote if len(vote_query) > 0 else None
+            post['is_upvote'] = my_votes.get(post['post'].id)
 
     # TODO: Implement post filtering logic/community selection logic
     return render_template(
         'index.html',
         posts=posts,
         logged_in=current_user.is_authenticated,
-        query=query)
+        query=query,
+        sort=sort,
+        window=window,
+        next_cursor=next_cursor)
 
 
 # This callback is used to reload the user object from the user ID stored in the session
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return cached_user(int(user_id))
 
 
 # The wrapper function for the login route
@@ -121,6 +233,12 @@ def require_login(func):
     return wrapper
 
 
+# Route for checking how far behind each peer is on this node's commands
+@app.route('/status/replication')
+def replication_status():
+    return jsonify(node.gossip_protocol.replication_status())
+
+
 # Route for logging in to the application
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -135,9 +253,15 @@ def login():
         if user is None:
             flash('Username does not exist.')
             return redirect(url_for('login'))
-        elif not user.check_password(form.password.data):
+        try:
+            matches = user.check_password(form.password.data)
+        except (Overloaded, futures.TimeoutError):
+            flash('Too many people are logging in right now. Please try again in a moment.')
+            return render_template('login.html', form=form), 503
+        if not matches:
             flash('Invalid password.')
             return redirect(url_for('login'))
+        db.session.commit()  # Keeps the hash if check_password upgraded it
 
         login_user(user)
         flash('Logged in successfully.')
@@ -168,11 +292,16 @@ def register():
         if query is not None:
             flash('Username already exists.')
             return redirect(url_for('register'))
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except (Overloaded, futures.TimeoutError):
+            flash('Too many people are signing up right now. Please try again in a moment.')
+            return render_template('register.html', form=form), 503
         db.session.add(user)
         db.session.commit()
+        users.invalidate(user.id)
 
-        node.broadcast_user(user)
+        remember_write(node.broadcast_user(user))
 
         flash('Congratulations, you are now a registered user! You are logged in.')
 
@@ -186,13 +315,14 @@ def register():
 # Route for viewing a user's profile, or the current user's profile if no user ID is specified
 @app.route('/profile', defaults={'user_id': None})
 @app.route('/profile/<int:user_id>')
+@read_only
 def profile(user_id):
     if user_id is None:
         if current_user.is_authenticated:
             user_id = current_user.id
         else:
             return redirect(url_for('index'))
-    user = User.query.get(user_id)
+    user = cached_user(user_id)
 
     if current_user.is_authenticated:
         is_current_user = user_id == current_user.id
@@ -200,10 +330,12 @@ def profile(user_id):
         is_current_user = False
 
     if user:
-        posts = Post.query.filter_by(author_id=user_id, deleted=False).order_by(
-            Post.date_posted.desc()).all()
+        posts, next_cursor = Post.keyset_page(
+            Post.query.filter_by(author_id=user_id, deleted=False), request.args.get('after'), POSTS_PER_PAGE)
+        load_authors({post.author_id for post in posts})
         # is_current_user is used to determine whether to show the logout button
-        return render_template('profile.html', user=user, posts=posts, is_current_user=is_current_user)
+        return render_template('profile.html', user=user, posts=posts, is_current_user=is_current_user,
+                               next_cursor=next_cursor)
     return redirect(url_for('index'))
 
 
@@ -213,12 +345,12 @@ def profile(user_id):
 def create_post():
     form = PostForm()
     if form.validate_on_submit():
-        post = Post(title=form.title.data, content=form.content.data, author=current_user, date_posted=datetime.utcnow())
+        post = Post(title=form.title.data, content=form.content.data, author_id=current_user.id, date_posted=datetime.utcnow())
         if form.anonymous.data:
             post.anonymous = True
         db.session.add(post)
         db.session.commit()
-        node.broadcast_post(post)
+        remember_write(node.broadcast_post(post))
         flash('Your post has been created!')
         return redirect(url_for('index'))
     return render_template('create_post.html', title='Make a Post', form=form)
@@ -234,19 +366,19 @@ def create_comment(post_id, parent_id=None):
         if parent_id:
             parent_id = int(parent_id)
             comment = Comment(
-                content=form.content.data, author=current_user,
+                content=form.content.data, author_id=current_user.id,
                 post_id=post_id, date_posted=datetime.utcnow(), parent_id=parent_id
             )
         else:
             comment = Comment(
-                content=form.content.data, author=current_user,
+                content=form.content.data, author_id=current_user.id,
                 post_id=post_id, date_posted=datetime.utcnow()
             )
         if form.anonymous.data:
             comment.anonymous = True
         db.session.add(comment)
         db.session.commit()
-        node.broadcast_comment(comment)
+        remember_write(node.broadcast_comment(comment))
     return redirect(url_for('post', post_id=post_id))
 
 
@@ -259,7 +391,8 @@ def delete_post(post_id):
         if post.author_id == current_user.id:
             post.delete()
             db.session.commit()
-            node.broadcast_delete_post(post)
+            fragments.invalidate('post', post.id)
+            remember_write(node.broadcast_delete_post(post))
             flash('Post deleted.')
         else:
             flash('You cannot delete a post that is not yours.')
@@ -279,6 +412,8 @@ def delete_comment(comment_id):
         if comment.author_id == current_user.id:
             comment.delete()
             db.session.commit()
+            fragments.invalidate('comment', comment.id)
+            remember_write(node.broadcast_delete_comment(comment))
             flash('Comment deleted.')
         else:
             flash('You cannot delete a comment that is not yours.')
@@ -327,26 +462,30 @@ def upvote(is_post, post_id, comment_id, on_post_page):
         if has_voted:
             vote = vote_query[0]
             db.session.delete(vote)
+            content.tally_vote(vote.is_upvote, -1)
             db.session.commit()
-            if vote.is_upvote:
-                # Remove the vote from the database
-                node.broadcast_delete_vote(vote)
-            else:
+            # Remove the vote from the database; a swapped vote gets a new id, so peers
+            # must drop the old row before they take the new one
+            remember_write(node.broadcast_delete_vote(vote))
+            if not vote.is_upvote:
                 # Swap from downvote to upvote
                 db.session.add(new_vote)
+                content.tally_vote(True, 1)
                 db.session.commit()
                 content.votes.append(new_vote)
-                node.broadcast_vote(new_vote)
+                remember_write(node.broadcast_vote(new_vote))
 
         # Else, register upvote
         else:
             db.session.add(new_vote)
+            content.tally_vote(True, 1)
             db.session.commit()
 
             content.votes.append(new_vote)
-            node.broadcast_vote(new_vote)
+            remember_write(node.broadcast_vote(new_vote))
 
         db.session.commit()
+        fragments.invalidate('post' if is_post else 'comment', id)
 
 
     return redirect(url_for('post', post_id=post_id)) if on_post_page else redirect(url_for('index'))
@@ -390,59 +529,56 @@ def downvote(is_post, post_id, comment_id, on_post_page):
         if has_voted:
             vote = vote_query[0]
             db.session.delete(vote)
+            content.tally_vote(vote.is_upvote, -1)
             db.session.commit()
-            if not vote.is_upvote:
-                # Remove the vote from the database
-                node.broadcast_delete_vote(vote)
-            else:
-                # Swap from downvote to upvote
+            # Remove the vote from the database; a swapped vote gets a new id, so peers
+            # must drop the old row before they take the new one
+            remember_write(node.broadcast_delete_vote(vote))
+            if vote.is_upvote:
+                # Swap from upvote to downvote
                 db.session.add(new_vote)
+                content.tally_vote(False, 1)
                 db.session.commit()
                 content.votes.append(new_vote)
-                node.broadcast_vote(new_vote)
+                remember_write(node.broadcast_vote(new_vote))
 
         # Else, register upvote
         else:
             db.session.add(new_vote)
+            content.tally_vote(False, 1)
             db.session.commit()
             content.votes.append(new_vote)
-            node.broadcast_vote(new_vote)
+            remember_write(node.broadcast_vote(new_vote))
 
         db.session.commit()
+        fragments.invalidate('post' if is_post else 'comment', id)
 
     return redirect(url_for('post', post_id=post_id)) if on_post_page else redirect(url_for('index'))
 
 
 @app.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@read_only
 def post(post_id):
-    def get_comment_tree(comment):
-        """Returns a dictionary representing the comment and all its descendants."""
-        return {
-            'comment': comment,
-            'children': [get_comment_tree(child) for child in comment.children],
-        }
-
-    def add_is_upvote(comment):
-        content = comment['comment']
-        vote_query = content.votes.filter_by(user_id=user_id, comment_id=content.id).all()
-        is_upvote = vote_query[0].is_upvote if len(vote_query) > 0 else None
-        comment['is_upvote'] = is_upvote
-        [add_is_upvote(child) for child in comment['children']]
+    def walk(comments):
+        """Yields every comment dictionary in the given trees."""
+        for comment in comments:
+            yield comment
+            yield from walk(comment['children'])
 
 
     post = {'post': Post.query.get(post_id)}
     if post['post']:
-        root_comments = Comment.query.filter_by(post_id=post_id, parent_id=None).order_by(Comment.date_posted.desc()).all()
-        comment_trees = [get_comment_tree(comment) for comment in root_comments]
+        comment_trees = Comment.thread(post_id)
+        load_authors([post['post'].author_id] + [comment['comment'].author_id for comment in walk(comment_trees)])
 
         # Logic to properly display user upvotes/downvotes
         if current_user.is_authenticated:
             user_id = current_user.id
-            vote_query = post['post'].votes.filter_by(
-                user_id=user_id, post_id=post['post'].id
-            ).all()
-            post['is_upvote'] = vote_query[0].is_upvote if len(vote_query) > 0 else None
-            [add_is_upvote(comment) for comment in comment_trees]
+            post['is_upvote'] = Vote.post_votes_by(user_id, [post_id]).get(post_id)
+            comments = list(walk(comment_trees))
+            my_votes = Vote.comment_votes_by(user_id, [comment['comment'].id for comment in comments])
+            for comment in comments:
+                comment['is_upvote'] = my_votes.get(comment['comment'].id)
 
         return render_template('post.html', post=post, form=CommentForm(), comments=comment_trees, logged_in=current_user.is_authenticated)
 
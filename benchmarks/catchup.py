@@ -0,0 +1,46 @@
+'''Catch-up throughput of the replicated apply path: commands per second
+applied through gossip.commit_commands to an on-disk database and commit
+log, one command per transaction (as before group commit) vs. batches.
+
+    python benchmarks/catchup.py
+'''
+import os
+import tempfile
+import time
+
+from common import make_app
+from commitlog import CommitLog
+from models import db
+from replication_db import open_replication_db
+from replication_format import RECORDS, changes
+
+import gossip
+import p2psync_pb2 as pb2
+
+
+def main():
+    commands = [pb2.DatabaseCommand(timestamp=n, change=RECORDS[kind](obj), origin='peer:8000', seq=n)
+                for n, (kind, obj) in enumerate(changes(500), 1)]
+
+    print(f'{"batch size":>10} {"commands":>9} {"seconds":>8} {"commands/s":>11}')
+    for batch_size in (1, 10, 100, 1000):
+        with tempfile.TemporaryDirectory() as directory:
+            app = make_app('sqlite:///' + os.path.join(directory, 'catchup.db'))
+            # gossip keeps its state in module globals, set as GossipProtocol would
+            with app.app_context():
+                gossip.ENGINE, gossip.SESSION = open_replication_db(db.engine)
+            gossip.commit_log = CommitLog(os.path.join(directory, 'commit.log'))
+            gossip.commit_counter, gossip.high_water = 0, {}
+
+            start = time.perf_counter()
+            for i in range(0, len(commands), batch_size):
+                gossip.commit_commands(commands[i:i + batch_size])
+            elapsed = time.perf_counter() - start
+            gossip.ENGINE.dispose()
+            with app.app_context():
+                db.engine.dispose()
+        print(f'{batch_size:>10} {len(commands):>9} {elapsed:>8.2f} {len(commands) / elapsed:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
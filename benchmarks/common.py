@@ -0,0 +1,81 @@
+'''Shared helpers for the benchmarks: a throwaway Flask app bound to an
+in-memory database, the real web app on a scratch node, and a counter for
+the SQL statements they execute.'''
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import Comment, Post, User, db
+
+
+def make_app(uri='sqlite://'):
+    '''Builds an app with the real models on a scratch database (in memory by default)'''
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def load_web_app(directory, port, **settings):
+    '''Imports app.py, the web app and node as they run, without the startup prompt:
+       a node on `port` that joins no network, with its databases, commit log and
+       snapshots in `directory`. Other config.py settings may be overridden by
+       keyword. Returns the app module; it can only be loaded once per process.'''
+    import config
+    uri = f'sqlite:///{os.path.join(directory, "miniatureddit.db")}'
+    config.PEER, config.PORT = 'None', port
+    config.SQLALCHEMY_DATABASE_URI = uri
+    config.SQLALCHEMY_BINDS = {'master': uri, 'slave': f'sqlite:///{os.path.join(directory, "replica.db")}'}
+    for name, value in settings.items():
+        setattr(config, name, value)
+    os.chdir(directory)
+    import app
+    return app
+
+
+@contextmanager
+def count_queries():
+    '''Counts the statements sent to the database inside the block: `with count_queries() as n: ... n[0]`'''
+    counter = [0]
+
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def seed(n_posts, comments_per_post=0, n_users=1):
+    '''Inserts n_users users and n_posts posts with a flat-ish comment thread on each; returns the users'''
+    users = [User(username=f'user{i}', password_hash='x') for i in range(n_users)]
+    db.session.add_all(users)
+    db.session.flush()
+    start = datetime.utcnow() - timedelta(days=1)
+    for i in range(n_posts):
+        post = Post(title=f'post {i}', content=f'content of post {i}', author_id=users[i % n_users].id,
+                    date_posted=start + timedelta(seconds=i))
+        db.session.add(post)
+        db.session.flush()
+        parent = None
+        for j in range(comments_per_post):
+            comment = Comment(post_id=post.id, author_id=users[j % n_users].id, content=f'comment {j}',
+                              date_posted=start + timedelta(seconds=i, milliseconds=j),
+                              parent_id=parent.id if parent is not None and j % 3 else None)
+            db.session.add(comment)
+            db.session.flush()
+            parent = comment
+    db.session.commit()
+    return users
@@ -0,0 +1,125 @@
+'''Simulates a cluster of nodes in one process, each a P2PSyncServer on
+localhost with its own in-memory database, and measures how a write spreads:
+time until every node has it, SendCommands calls it took, and how many of
+those the writer made, for broadcast-to-all vs. gossip fan-outs.
+
+    python benchmarks/gossip_sim.py [nodes] [writes]
+
+gossip.py keeps a node's state in module globals, so every simulated node
+loads its own copy of the module. Membership is wired up directly rather
+than through Connect, and anti-entropy is switched off, so that only the
+push path is measured.
+'''
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent import futures
+from datetime import datetime
+from types import SimpleNamespace
+
+from common import make_app
+
+from channels import SERVER_OPTIONS
+import grpc
+import p2psync_pb2_grpc as pb2_grpc
+import records
+
+GOSSIP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gossip.py')
+BASE_PORT = 19500
+TIMEOUT = 5  # Seconds to wait for a write to reach every node
+
+
+def load_gossip(name):
+    '''A fresh copy of the gossip module, with globals of its own'''
+    spec = importlib.util.spec_from_file_location(name, GOSSIP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Node:
+    def __init__(self, port, fanout, counts):
+        self.address = f'127.0.0.1:{port}'
+        self.gossip = load_gossip(f'gossip_{port}')
+        self.gossip.GOSSIP_FANOUT = fanout
+        self.gossip.ANTI_ENTROPY_INTERVAL = 1e9
+        app = make_app()
+        self.protocol = self.gossip.GossipProtocol('127.0.0.1', port, None, None, app.app_context())
+
+        class CountingServer(self.gossip.P2PSyncServer):
+            def SendCommands(self, request, context):
+                counts['calls'] += 1
+                counts['senders'][request.sender] = counts['senders'].get(request.sender, 0) + 1
+                return super().SendCommands(request, context)
+
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS)
+        pb2_grpc.add_P2PSyncServicer_to_server(CountingServer(), self.server)
+        self.server.add_insecure_port(self.address)
+        self.server.start()
+
+    def has(self, origin, seq):
+        return self.gossip.high_water.get(origin, 0) >= seq
+
+    def stop(self):
+        self.server.stop(None)
+        self.protocol.stop()
+
+
+def simulate(n_nodes, n_writes, fanout, base_port):
+    counts = {'calls': 0, 'senders': {}}
+    nodes = [Node(base_port + i, fanout, counts) for i in range(n_nodes)]
+    for node in nodes:
+        for other in nodes:
+            if other is not node:
+                node.gossip.membership.add(*other.address.rsplit(':', 1))
+
+    latencies, reached, coverage, writer_calls, calls = [], 0, [], [], []
+    for i in range(n_writes):
+        writer = random.choice(nodes)
+        post = SimpleNamespace(id=base_port * 1000 + i, title=f'post {i}', content='x', author_id=1,
+                               anonymous=False, date_posted=datetime.utcnow(), deleted=False)
+        counts['calls'], counts['senders'] = 0, {}
+        start = time.perf_counter()
+        writer.protocol.broadcast(records.post_record(post))
+        seq = writer.gossip.high_water[writer.address]
+        while time.perf_counter() - start < TIMEOUT:
+            if all(node.has(writer.address, seq) for node in nodes):
+                latencies.append(time.perf_counter() - start)
+                reached += 1
+                break
+            time.sleep(0.001)
+        time.sleep(0.05)  # Let the last forwards of duplicates land before counting
+        coverage.append(sum(node.has(writer.address, seq) for node in nodes) / n_nodes)
+        calls.append(counts['calls'])
+        writer_calls.append(counts['senders'].get(writer.address, 0))
+
+    for node in nodes:
+        node.stop()
+    return latencies, reached, coverage, calls, writer_calls
+
+
+def main():
+    n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_writes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    os.chdir(tempfile.mkdtemp())  # Nodes write their commit logs to the working directory
+
+    print(f'{n_nodes} nodes, {n_writes} writes')
+    print(f'{"fanout":>6} {"reached all":>12} {"nodes reached":>14} {"mean ms":>8} {"p95 ms":>7} '
+          f'{"calls/write":>12} {"writer calls":>13}')
+    for run, fanout in enumerate((n_nodes - 1, 2, 3, 4, 6)):
+        latencies, reached, coverage, calls, writer_calls = simulate(n_nodes, n_writes, fanout, BASE_PORT + run * 100)
+        label = 'all' if fanout == n_nodes - 1 else str(fanout)
+        # Latencies only count the writes that reached every node
+        latencies = sorted(latencies) or [float('nan')]
+        p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+        print(f'{label:>6} {f"{reached}/{n_writes}":>12} {statistics.mean(coverage):>14.1%} '
+              f'{statistics.mean(latencies) * 1000:>8.1f} {p95 * 1000:>7.1f} '
+              f'{statistics.mean(calls):>12.1f} {statistics.mean(writer_calls):>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
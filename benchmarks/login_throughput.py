@@ -0,0 +1,89 @@
+'''Login throughput under concurrency: PBKDF2 password checks on the request
+threads (as before) vs. in the password hashing process pool, with a burst of
+concurrent logins. Also times a cheap page query made during the burst, which
+is what other visitors wait on while the logins are hashed.
+
+    python benchmarks/login_throughput.py [logins per thread]
+'''
+import sys
+import threading
+import time
+
+from passlib.hash import pbkdf2_sha256
+
+from common import make_app, seed
+from config import PASSWORD_QUEUE_LIMIT, PASSWORD_ROUNDS, PASSWORD_SALT_SIZE, PASSWORD_WORKERS
+from models import Post
+from passwords import Overloaded, hasher
+
+PASSWORD = 'correct horse battery staple'
+
+
+def in_thread(password_hash):
+    return pbkdf2_sha256.verify(PASSWORD, password_hash)
+
+
+def in_pool(password_hash):
+    return hasher.verify(PASSWORD, password_hash)[0]
+
+
+def burst(check, password_hash, app, threads, logins):
+    latencies, rejected, page_times = [], [0], []
+    done = threading.Event()
+
+    def login():
+        for _ in range(logins):
+            start = time.perf_counter()
+            try:
+                assert check(password_hash)
+            except Overloaded:
+                rejected[0] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    def browse():
+        with app.app_context():
+            while not done.is_set():
+                start = time.perf_counter()
+                Post.query.order_by(Post.hot.desc()).limit(20).all()
+                page_times.append(time.perf_counter() - start)
+                time.sleep(0.005)
+
+    browser = threading.Thread(target=browse)
+    browser.start()
+    workers = [threading.Thread(target=login) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    browser.join()
+    return latencies, rejected[0], page_times, elapsed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else float('nan')
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    hasher.start()  # Fork the workers before any threads exist
+    app = make_app()
+    with app.app_context():
+        seed(200, n_users=10)
+    password_hash = pbkdf2_sha256.using(rounds=PASSWORD_ROUNDS, salt_size=PASSWORD_SALT_SIZE).hash(PASSWORD)
+
+    print(f'{PASSWORD_ROUNDS} rounds, {PASSWORD_WORKERS} worker processes, queue limit {PASSWORD_QUEUE_LIMIT}')
+    print(f'{"mode":>8} {"threads":>8} {"logins/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"rejected":>9} {"page p99 ms":>12}')
+    for threads in (1, 8, 32, 128):
+        for mode, check in (('thread', in_thread), ('pool', in_pool)):
+            latencies, rejected, page_times, elapsed = burst(check, password_hash, app, threads, logins)
+            print(f'{mode:>8} {threads:>8} {len(latencies) / elapsed:>9.1f} {percentile(latencies, 0.5) * 1000:>8.0f} '
+                  f'{percentile(latencies, 0.99) * 1000:>8.0f} {rejected:>9} {percentile(page_times, 0.99) * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''Counts the SQL statements behind the homepage, profile and post pages as the
+number of items on them grows. The pages are requested through the app's own
+routes and templates, by a logged-in viewer, and counted by the app's SQL
+metrics, so loading the viewer for the session is included. The user and
+fragment caches are cleared before the first request for each page, so that is
+the cold count; a second request shows what the caches save. Exits with
+status 1 if a cold page takes more statements than its bound in BOUNDS.
+
+    python benchmarks/page_queries.py
+'''
+import sys
+import tempfile
+from datetime import datetime
+
+from prometheus_client import REGISTRY
+
+from common import load_web_app, seed
+from cache import fragments, users
+from models import Comment, Post, User, db
+
+PORT = 19400
+SIZES = (5, 20, 100)
+# Statements per page, whatever the number of items on it
+BOUNDS = {
+    'index': 4,    # The viewer, posts, authors, the viewer's votes
+    'profile': 2,  # The viewer, who wrote every post on their profile, and the posts
+    'post': 5,     # The post, its comments, authors with the viewer, the viewer's votes on each
+}
+
+
+def statements(route):
+    '''Statements made so far by requests to `route`, as the app's metrics counted them'''
+    return REGISTRY.get_sample_value('sql_statements_per_request_sum', {'route': route}) or 0
+
+
+def count(client, route, url):
+    before = statements(route)
+    response = client.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+    return int(statements(route) - before)
+
+
+def main():
+    # Seeded rows go straight into the primary, not through the commit log to the replica
+    web = load_web_app(tempfile.mkdtemp(), PORT, AUTO_READ_ON_SLAVE=False, METRICS_ENABLED=True)
+    web.app.config['WTF_CSRF_ENABLED'] = False
+    client = web.app.test_client()
+    client.post('/register', data={'username': 'viewer', 'password': 'pw', 'confirm_password': 'pw'})
+
+    failed = False
+    with web.app.app_context():
+        viewer_id = User.query.filter_by(username='viewer').one().id
+        everyone = seed(n_posts=max(SIZES), n_users=max(SIZES))  # Each post on the homepage by someone else
+        for i in range(max(SIZES)):
+            # Older than the seeded posts, so they fill the viewer's profile but not the homepage
+            db.session.add(Post(title=f'mine {i}', content='x', author_id=viewer_id, date_posted=datetime(2000, 1, 1)))
+        threads = {}
+        for size in SIZES:
+            post = Post(title=f'thread of {size}', content='x', author_id=viewer_id, date_posted=datetime(2000, 1, 1))
+            db.session.add(post)
+            db.session.flush()
+            for i in range(size):
+                db.session.add(Comment(post_id=post.id, author_id=everyone[i % len(everyone)].id,
+                                       content=f'comment {i}', date_posted=datetime.utcnow()))
+            threads[size] = post.id
+        db.session.commit()
+
+    print(f'{"page":>8} {"items":>6} {"cold":>5} {"cached":>7} {"bound":>6}')
+    for size in SIZES:
+        web.POSTS_PER_PAGE = size
+        pages = {'index': '/', 'profile': '/profile', 'post': f'/post/{threads[size]}'}
+        for name, url in pages.items():
+            users.clear()
+            fragments.clear()
+            cold, cached = count(client, name, url), count(client, name, url)
+            failed |= cold > BOUNDS[name]
+            print(f'{name:>8} {size:>6} {cold:>5} {cached:>7} {BOUNDS[name]:>6}'
+                  f'{"" if cold <= BOUNDS[name] else "  over the bound"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
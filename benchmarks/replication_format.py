@@ -0,0 +1,104 @@
+'''Compares the old replication format, SQL strings in a "N|command" text log
+executed one by one, with binary change records applied through
+records.apply_changes: bytes in the log and time to apply a catch-up.
+
+    python benchmarks/replication_format.py
+'''
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from common import make_app
+from commitlog import LENGTH
+from models import db, recount_votes
+from sqlalchemy import text
+
+import p2psync_pb2 as pb2
+import records
+
+
+def changes(n_posts):
+    '''A mix of writes like a busy node's: each post gets three comments and four votes'''
+    start = datetime.utcnow() - timedelta(days=1)
+    user = SimpleNamespace(id=1, username='user0', password_hash='$5$rounds=535000$' + 'x' * 59, date_created=start)
+    yield 'user', user
+    comment_id = vote_id = 0
+    for i in range(1, n_posts + 1):
+        yield 'post', SimpleNamespace(id=i, title=f'post {i}', content=f'content of post {i} ' * 8, author_id=1,
+                                      anonymous=False, date_posted=start + timedelta(seconds=i), deleted=False)
+        for j in range(3):
+            comment_id += 1
+            yield 'comment', SimpleNamespace(id=comment_id, post_id=i, author_id=1, content=f'comment {j} ' * 4,
+                                             anonymous=False, date_posted=start + timedelta(seconds=i, milliseconds=j),
+                                             parent_id=None, deleted=False)
+        for j in range(4):
+            vote_id += 1
+            yield 'vote', SimpleNamespace(id=vote_id, user_id=1, post_id=i if j % 2 else -1,
+                                          comment_id=-1 if j % 2 else comment_id, is_upvote=j < 3)
+
+
+def sql_command(kind, obj):
+    '''The SQL string the node used to broadcast for a write'''
+    if kind == 'user':
+        return f"INSERT INTO user (id, username, password_hash, date_created) VALUES \
+                    ({obj.id}, '{obj.username}', '{obj.password_hash}', '{obj.date_created}');"
+    if kind == 'post':
+        return f"INSERT INTO post (id, title, content, author_id, anonymous, date_posted, deleted) VALUES \
+                    ({obj.id}, '{obj.title}', '{obj.content}', {obj.author_id}, \
+                    {obj.anonymous}, '{obj.date_posted}', {obj.deleted});"
+    if kind == 'comment':
+        return f"INSERT INTO comment (id, post_id, author_id, content, anonymous, date_posted, deleted) VALUES \
+                    ({obj.id}, {obj.post_id}, {obj.author_id}, '{obj.content}', \
+                    {obj.anonymous}, '{obj.date_posted}', {obj.deleted});"
+    return f"REPLACE INTO vote (id, user_id, post_id, comment_id, is_upvote) VALUES \
+                    ({obj.id}, {obj.user_id}, {obj.post_id}, \
+                    {obj.comment_id}, {obj.is_upvote});"
+
+
+RECORDS = {'user': records.user_record, 'post': records.post_record,
+           'comment': records.comment_record, 'vote': records.vote_record}
+
+
+def apply_sql(log):
+    for line in log.decode().splitlines():
+        db.session.execute(text(line.split('|', 1)[1]))
+    # Raw SQL leaves the vote counters and rankings behind the vote table
+    recount_votes()
+
+
+def apply_records(log):
+    commands, offset = [], 0
+    while offset < len(log):
+        length, = LENGTH.unpack_from(log, offset)
+        commands.append(pb2.DatabaseCommand.FromString(log[offset + LENGTH.size:offset + LENGTH.size + length]))
+        offset += length + 2 * LENGTH.size
+    records.apply_changes([command.change for command in commands])
+    db.session.commit()
+
+
+def main():
+    app = make_app()
+    print(f'{"commits":>8} {"SQL bytes":>10} {"SQL ms":>9} {"record bytes":>13} {"record ms":>10}')
+    for n_posts in (100, 500, 2000):
+        writes = list(changes(n_posts))
+        sql_log = ''.join(f'{n}|{sql_command(kind, obj)}\n'
+                          for n, (kind, obj) in enumerate(writes, 1)).encode()
+        frames = []
+        for n, (kind, obj) in enumerate(writes, 1):
+            payload = pb2.DatabaseCommand(timestamp=n, change=RECORDS[kind](obj)).SerializeToString()
+            frames += [LENGTH.pack(len(payload)), payload, LENGTH.pack(len(payload))]
+        record_log = b''.join(frames)
+
+        row = [len(writes)]
+        with app.app_context():
+            for log, apply in ((sql_log, apply_sql), (record_log, apply_records)):
+                db.drop_all()
+                db.create_all()
+                start = time.perf_counter()
+                apply(log)
+                row += [len(log), (time.perf_counter() - start) * 1000]
+        print('{:>8} {:>10} {:>9.1f} {:>13} {:>10.1f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
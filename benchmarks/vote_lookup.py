@@ -0,0 +1,54 @@
+'''Compares the per-item "did I vote on this?" lookups with the batched
+Vote.post_votes_by/comment_votes_by maps, counting SQL statements per page.
+
+    python benchmarks/vote_lookup.py
+'''
+import random
+import time
+
+from common import count_queries, make_app, seed
+from models import Comment, Post, Vote, db
+
+
+def per_item(user_id, posts, comments):
+    for post in posts:
+        votes = post.votes.filter_by(user_id=user_id, post_id=post.id).all()
+        _ = votes[0].is_upvote if votes else None
+    for comment in comments:
+        votes = comment.votes.filter_by(user_id=user_id, comment_id=comment.id).all()
+        _ = votes[0].is_upvote if votes else None
+
+
+def batched(user_id, posts, comments):
+    Vote.post_votes_by(user_id, [post.id for post in posts])
+    Vote.comment_votes_by(user_id, [comment.id for comment in comments])
+
+
+def main():
+    app = make_app()
+    with app.app_context():
+        user, = seed(n_posts=200, comments_per_post=5)
+        for post in Post.query.all():
+            if random.random() < 0.5:
+                db.session.add(Vote(user_id=user.id, post_id=post.id, comment_id=-1, is_upvote=random.random() < 0.5))
+        for comment in Comment.query.all():
+            if random.random() < 0.5:
+                db.session.add(Vote(user_id=user.id, post_id=-1, comment_id=comment.id, is_upvote=random.random() < 0.5))
+        db.session.commit()
+
+        print(f'{"items":>6} {"per-item queries":>17} {"per-item ms":>12} {"batched queries":>16} {"batched ms":>11}')
+        for size in (10, 50, 100, 200):
+            posts = Post.query.limit(size).all()
+            comments = Comment.query.limit(size).all()
+            row = [size]
+            for lookup in (per_item, batched):
+                with count_queries() as queries:
+                    start = time.perf_counter()
+                    lookup(user.id, posts, comments)
+                    elapsed = (time.perf_counter() - start) * 1000
+                row += [queries[0], elapsed]
+            print('{:>6} {:>17} {:>12.2f} {:>16} {:>11.2f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from config import FRAGMENT_CACHE_SIZE, USER_CACHE_SIZE, USER_CACHE_TTL
+
+
+class LRUCache:
+    '''Thread-safe in-process cache holding at most `maxsize` entries, evicting
+       the least recently used. Any object with the same get/set/clear methods
+       (e.g. a client for a cache shared by the processes of a node) can stand
+       in for it as a FragmentCache backend.'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FragmentCache:
+    '''Rendered HTML fragments keyed by (kind, content id, version, variant).
+       Writing a post, comment or vote calls invalidate(), which gives the content
+       a new version so its old fragments are never read again and age out of the
+       backend. Fragments must not contain anything specific to the viewer beyond
+       their variant; per-viewer parts are left as placeholders and filled in by
+       the caller on every render.'''
+    def __init__(self, backend):
+        self.backend = backend
+
+    def version(self, kind, content_id):
+        key = f'version:{kind}:{content_id}'
+        version = self.backend.get(key)
+        if version is None:
+            # Unknown or evicted: any fragments cached under an older version become unreachable
+            version = uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def invalidate(self, kind, content_id):
+        self.backend.set(f'version:{kind}:{content_id}', uuid4().hex)
+
+    def get_or_render(self, kind, content_id, variant, render):
+        '''Returns the cached fragment, calling render() to produce it on a miss'''
+        key = f'fragment:{kind}:{content_id}:{self.version(kind, content_id)}:{variant}'
+        fragment = self.backend.get(key)
+        if fragment is None:
+            fragment = render()
+            self.backend.set(key, fragment)
+        return fragment
+
+    def clear(self):
+        self.backend.clear()
+
+
+class UserCache:
+    '''Users by id, for the session loader and feed rendering, each trusted for at
+       most `ttl` seconds. Ids with no user are cached too, as None, so whatever
+       inserts a user (registration, a replicated record) must invalidate() its id.'''
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.generation = 0  # Bumped by invalidate(), so a load that raced with one is not stored
+
+    def get_many(self, user_ids, load):
+        '''user id -> user, or None if there is none. The uncached ids are passed to
+           load(ids) together, which returns user id -> user for those that exist.'''
+        now = time.monotonic()
+        found, missing = {}, []
+        for user_id in set(user_ids):
+            entry = self.backend.get(user_id)
+            if entry is not None and entry[0] > now:
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        if missing:
+            generation = self.generation
+            loaded = load(missing)
+            for user_id in missing:
+                found[user_id] = loaded.get(user_id)
+                if generation == self.generation:
+                    self.backend.set(user_id, (now + self.ttl, found[user_id]))
+        return found
+
+    def invalidate(self, user_id):
+        self.generation += 1
+        self.backend.set(user_id, None)
+
+    def clear(self):
+        self.generation += 1
+        self.backend.clear()
+
+
+class NoCache:
+    '''Backend that stores nothing, used when FRAGMENT_CACHE_SIZE or USER_CACHE_SIZE is 0'''
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+# Shared by the web routes and the replication server, which invalidates
+# fragments for the commands it applies from peers
+fragments = FragmentCache(LRUCache(FRAGMENT_CACHE_SIZE) if FRAGMENT_CACHE_SIZE else NoCache())
+
+# Users for load_user and author names, shared the same way; records.py invalidates
+# the ids of the users it inserts
+users = UserCache(LRUCache(USER_CACHE_SIZE) if USER_CACHE_SIZE else NoCache(), USER_CACHE_TTL)
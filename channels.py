@@ -0,0 +1,83 @@
+import threading
+
+from config import GRPC_KEEPALIVE_TIME_MS, GRPC_KEEPALIVE_TIMEOUT_MS, GRPC_MAX_RECONNECT_BACKOFF_MS
+
+import p2psync_pb2_grpc as pb2_grpc
+import grpc
+
+# Keep idle connections to peers open, and notice dead ones, by pinging them
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', GRPC_KEEPALIVE_TIME_MS),
+    ('grpc.keepalive_timeout_ms', GRPC_KEEPALIVE_TIMEOUT_MS),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.initial_reconnect_backoff_ms', 200),
+    ('grpc.max_reconnect_backoff_ms', GRPC_MAX_RECONNECT_BACKOFF_MS),
+]
+
+# Let peers ping our server as often as their channels are configured to
+SERVER_OPTIONS = [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', GRPC_KEEPALIVE_TIME_MS),
+    ('grpc.http2.max_ping_strikes', 0),
+]
+
+
+class PeerChannel:
+    '''A long-lived channel to one peer, with its stub and last known connectivity'''
+    def __init__(self, host, port):
+        self.channel = grpc.insecure_channel(f'{host}:{port}', options=CHANNEL_OPTIONS)
+        self.stub = pb2_grpc.P2PSyncStub(self.channel)
+        self.state = grpc.ChannelConnectivity.IDLE
+        self.channel.subscribe(self.on_state_change, try_to_connect=True)
+
+    def on_state_change(self, state):
+        self.state = state
+
+    def close(self):
+        self.state = grpc.ChannelConnectivity.SHUTDOWN
+        self.channel.unsubscribe(self.on_state_change)
+        # gRPC's connectivity poller notices the unsubscribe within a fraction of a
+        # second; closing the channel under it makes the poller thread raise
+        threading.Timer(1, self.channel.close).start()
+
+
+class ChannelPool:
+    '''One channel and stub per peer, reused by every RPC to that peer. gRPC
+       reconnects a channel by itself after a failure; a channel is only
+       replaced if it was closed, which happens when its peer leaves.'''
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def stub(self, host, port):
+        key = (host, str(port))
+        with self.lock:
+            peer_channel = self.channels.get(key)
+            if peer_channel is None or peer_channel.state == grpc.ChannelConnectivity.SHUTDOWN:
+                peer_channel = self.channels[key] = PeerChannel(*key)
+            return peer_channel.stub
+
+    def close(self, host, port):
+        '''Close the channel to a peer that left the network'''
+        with self.lock:
+            peer_channel = self.channels.pop((host, str(port)), None)
+        if peer_channel is not None:
+            peer_channel.close()
+
+    def health(self):
+        '''Connectivity of each pooled channel (IDLE, CONNECTING, READY,
+           TRANSIENT_FAILURE or SHUTDOWN), keyed by "host:port"'''
+        with self.lock:
+            return {f'{host}:{port}': peer_channel.state.name
+                    for (host, port), peer_channel in self.channels.items()}
+
+    def close_all(self):
+        with self.lock:
+            peer_channels, self.channels = list(self.channels.values()), {}
+        for peer_channel in peer_channels:
+            peer_channel.close()
+
+
+# Shared by the gossip protocol, the replication senders and the gRPC server
+channels = ChannelPool()
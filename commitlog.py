@@ -0,0 +1,228 @@
+import os
+import struct
+import threading
+from bisect import bisect_right
+
+from config import COMMIT_LOG_INDEX_STRIDE
+
+import p2psync_pb2 as pb2
+
+# Each entry is a serialized DatabaseCommand framed by its length, before and
+# after, so the log can be read forwards as well as backwards from its end
+LENGTH = struct.Struct('>I')
+# The file starts with a header that holds the last seq this node wrote, which
+# outlives the entries that truncate() drops
+HEADER = struct.Struct('>4sQ')
+MAGIC = b'CLG1'
+
+
+class CommitLog:
+    '''Append-only binary log of DatabaseCommands, in the order this node applied
+       them. Each command's timestamp is its position in this log; its origin and
+       seq say which node made the write, and in what order.
+       Commits up to `base` live in a database snapshot instead, and the log may
+       have been truncated behind it; `floor` holds the high-water mark of each
+       origin in that snapshot. A sparse in-memory index of byte offsets (one
+       entry every COMMIT_LOG_INDEX_STRIDE commands of an origin) lets readers
+       start near the first command they are missing; it is built on the first
+       read, so opening the log only looks at its header and last entry.
+       `own_seq` is the seq of the last command from `origin`, this node.'''
+    def __init__(self, filename, base=0, floor=None, origin=None):
+        self.filename = filename
+        self.base = base
+        self.floor = dict(floor or {})
+        self.origin = origin
+        self.own_seq = 0
+        self.lock = threading.Lock()
+        self.indexed = False
+        self.index = {}      # origin -> ([seq, ...], [byte offset of that command, ...]), ascending
+        self.last_seqs = {}  # origin -> seq of its last command in the log
+
+        if not os.path.exists(filename):
+            self.write_header(open(filename, 'wb'))
+        self.read_header()
+        self.repair()
+        last = next(self.read_backwards(), None)
+        self.last_commit = max(last.timestamp if last else 0, base)
+
+    def write_header(self, f):
+        '''Write the header at the start of an open file, and close it'''
+        with f:
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, self.own_seq))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_header(self):
+        '''Load own_seq from the header, adding one to a log written before there was
+           a header; that reads the log once, for the last command from `origin`'''
+        with open(self.filename, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) == HEADER.size and header[:len(MAGIC)] == MAGIC:
+            _, self.own_seq = HEADER.unpack(header)
+            return
+        temporary = self.filename + '.tmp'
+        with open(self.filename, 'rb') as f, open(temporary, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, 0))
+            for _, payload in self.frames(f):
+                command = pb2.DatabaseCommand.FromString(payload)
+                if command.origin == self.origin:
+                    self.own_seq = command.seq
+                length = LENGTH.pack(len(payload))
+                out.write(length + payload + length)
+        self.write_header(open(temporary, 'r+b'))
+        os.replace(temporary, self.filename)
+
+    @staticmethod
+    def frames(f):
+        '''Yields (offset, payload) for each complete entry from the file's current position'''
+        offset = f.tell()
+        while True:
+            header = f.read(LENGTH.size)
+            if len(header) < LENGTH.size:
+                return
+            length, = LENGTH.unpack(header)
+            payload = f.read(length)
+            trailer = f.read(LENGTH.size)
+            if len(payload) < length or trailer != header:
+                return  # An entry torn by a crash, or a position that is not the start of one
+            yield offset, payload
+            offset += length + 2 * LENGTH.size
+
+    def repair(self):
+        '''Cut off an entry torn by a crash in the middle of a write, so that entries
+           appended from now on can be read'''
+        with open(self.filename, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == HEADER.size or self.entry_before(f, size) is not None:
+                return
+            f.seek(HEADER.size)
+            end = HEADER.size
+            for offset, payload in self.frames(f):
+                end = offset + len(payload) + 2 * LENGTH.size
+            f.truncate(end)
+
+    @staticmethod
+    def entry_before(f, end):
+        '''Offset of the entry that ends at byte `end`, or None if there is no complete one'''
+        if end < HEADER.size + 2 * LENGTH.size:
+            return None
+        f.seek(end - LENGTH.size)
+        length, = LENGTH.unpack(f.read(LENGTH.size))
+        start = end - length - 2 * LENGTH.size
+        if start < HEADER.size:
+            return None
+        f.seek(start)
+        return start if LENGTH.unpack(f.read(LENGTH.size)) == (length,) else None
+
+    def read_backwards(self):
+        '''Yields the DatabaseCommands in the log from the last one back'''
+        with open(self.filename, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            while (start := self.entry_before(f, end)) is not None:
+                yield pb2.DatabaseCommand.FromString(f.read(end - start - 2 * LENGTH.size))
+                end = start
+
+    def build_index(self):
+        self.index, self.last_seqs = {}, {}
+        with open(self.filename, 'rb') as f:
+            f.seek(HEADER.size)
+            for offset, payload in self.frames(f):
+                self.add_to_index(pb2.DatabaseCommand.FromString(payload), offset)
+        self.indexed = True
+
+    def add_to_index(self, command, offset):
+        seqs, offsets = self.index.setdefault(command.origin, ([], []))
+        if not seqs or command.seq - seqs[-1] >= COMMIT_LOG_INDEX_STRIDE:
+            seqs.append(command.seq)
+            offsets.append(offset)
+        self.last_seqs[command.origin] = command.seq
+
+    def append(self, commands, sync=False):
+        '''Append DatabaseCommands in one write; with sync=True, return only once
+           they are on disk. The header is updated if any of them is our own.'''
+        with self.lock:
+            own_seq = self.own_seq
+            with open(self.filename, 'r+b') as f:
+                offset = f.seek(0, os.SEEK_END)
+                data = []
+                for command in commands:
+                    if command.origin == self.origin:
+                        own_seq = max(own_seq, command.seq)
+                    payload = command.SerializeToString()
+                    length = LENGTH.pack(len(payload))
+                    if self.indexed:
+                        self.add_to_index(command, offset)
+                    offset += len(payload) + 2 * LENGTH.size
+                    data += [length, payload, length]
+                    self.last_commit = command.timestamp
+                f.write(b''.join(data))
+                if own_seq != self.own_seq:
+                    # Rewritten in place; the fsync below covers the header and the entries
+                    self.own_seq = own_seq
+                    f.seek(0)
+                    f.write(HEADER.pack(MAGIC, own_seq))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def covers(self, high_water):
+        '''Whether every command newer than the {origin: seq} high-water marks is
+           still in the log (if not, a reader must start from the snapshot)'''
+        return all(high_water.get(origin, 0) >= seq for origin, seq in self.floor.items())
+
+    def read_after(self, high_water):
+        '''Yields every DatabaseCommand whose seq is above the high-water mark of its origin'''
+        with self.lock:
+            if not self.indexed:
+                self.build_index()
+            # Start at the earliest indexed offset at or before a missing command of any origin
+            offset = None
+            for origin, (seqs, offsets) in self.index.items():
+                mark = high_water.get(origin, 0)
+                if mark >= self.last_seqs[origin]:
+                    continue
+                start = offsets[max(bisect_right(seqs, mark) - 1, 0)]
+                offset = start if offset is None else min(offset, start)
+            if offset is None:
+                return
+            # Opened under the lock, so the offset belongs to this file: truncate() and
+            # reset() replace the file rather than rewrite it, and we keep reading the old one
+            f = open(self.filename, 'rb')
+
+        with f:
+            f.seek(offset)
+            for _, payload in self.frames(f):
+                command = pb2.DatabaseCommand.FromString(payload)
+                if command.seq > high_water.get(command.origin, 0):
+                    yield command
+
+    def truncate(self, base, floor):
+        '''Drop every commit up to `base`, which a snapshot with the high-water marks
+           `floor` now covers'''
+        with self.lock:
+            temporary = self.filename + '.tmp'
+            with open(self.filename, 'rb') as f, open(temporary, 'wb') as out:
+                out.write(HEADER.pack(MAGIC, self.own_seq))
+                f.seek(HEADER.size)
+                for _, payload in self.frames(f):
+                    if pb2.DatabaseCommand.FromString(payload).timestamp > base:
+                        length = LENGTH.pack(len(payload))
+                        out.write(length + payload + length)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(temporary, self.filename)
+            self.base, self.floor = base, dict(floor)
+            self.last_commit = max(self.last_commit, base)
+            self.indexed = False
+
+    def reset(self, base, floor):
+        '''Empty the log after a snapshot up to commit `base`, with the high-water
+           marks `floor`, replaced the database. own_seq is kept.'''
+        with self.lock:
+            temporary = self.filename + '.tmp'
+            self.write_header(open(temporary, 'wb'))
+            os.replace(temporary, self.filename)
+            self.base = self.last_commit = base
+            self.floor = dict(floor)
+            self.indexed = False
@@ -1,10 +1,47 @@
 from secrets import token_hex
+import os
 import socket
 
 HOST = socket.gethostbyname(socket.gethostname())
 PORT = 8000
+PEER = ''  # Node to join as 'host:port', or 'None' to start a new network; left empty, it is asked for at startup
 
-COMMIT_LOG_FILE = f'commit_{HOST}_{PORT}.txt'
+COMMIT_LOG_FILE = f'commit_{HOST}_{PORT}.log'
+COMMIT_LOG_INDEX_STRIDE = 256  # Commands of one origin between byte offsets kept in the commit log's seek index
+LISTEN_BATCH_SIZE = 500        # Commands per message when streaming the commit log to a peer
+APPLY_BATCH_SIZE = 1000        # Most replicated commands applied in one database transaction
+ANTI_ENTROPY_INTERVAL = 30     # Seconds between digest exchanges with a random peer
+
+# Database snapshots, behind which the commit log is truncated
+SNAPSHOT_INTERVAL = 300         # Seconds between checks for whether to take a snapshot
+SNAPSHOT_MIN_COMMITS = 1000     # Commits since the last snapshot needed to take a new one
+SNAPSHOT_CHUNK_SIZE = 1 << 20   # Bytes per message when streaming a snapshot to a peer
+
+# The replication server's own database connections, apart from the web app's
+REPLICATION_DB_POOL_SIZE = 2      # Connections kept open; commit_lock lets one of them write at a time
+REPLICATION_DB_POOL_TIMEOUT = 30  # Seconds to wait for a free connection
+
+# Outbound replication: commands are shipped to peers in the background
+GOSSIP_FANOUT = 4                # Random peers each new command is sent or forwarded to
+REPLICATION_BATCH_SIZE = 100     # Most commands sent to a peer in one SendCommands call
+REPLICATION_QUEUE_LIMIT = 10000  # Commands queued per peer before the oldest are dropped
+REPLICATION_RETRY_BASE = 0.5     # Seconds before retrying a failed send, doubled per failure...
+REPLICATION_RETRY_MAX = 30       # ...up to this many seconds
+REPLICATION_RPC_TIMEOUT = 5      # Seconds to wait for a peer to accept a batch
+
+# Heartbeats and failure detection
+HEARTBEAT_INTERVAL = 1      # Seconds between heartbeats to each peer...
+HEARTBEAT_JITTER = 0.2      # ...give or take this fraction, so nodes do not all ping at once
+HEARTBEAT_TIMEOUT = 2       # Seconds to wait for a heartbeat reply
+HEARTBEAT_WINDOW = 100      # Gaps between replies the failure detector remembers per peer
+HEARTBEAT_SUSPECT_PHI = 3   # Suspicion level (phi) at which a peer is suspected...
+HEARTBEAT_DEAD_PHI = 8      # ...and at which it is declared dead and removed from the network
+HEARTBEAT_JOIN_GRACE = 60   # Seconds a new peer has to answer its first heartbeat before it is removed
+
+# Long-lived gRPC channels to peers
+GRPC_KEEPALIVE_TIME_MS = 30000         # Ping an idle peer connection this often...
+GRPC_KEEPALIVE_TIMEOUT_MS = 10000      # ...and treat it as broken if the ping is not answered in time
+GRPC_MAX_RECONNECT_BACKOFF_MS = 10000  # Longest wait between attempts to reconnect to a peer
 
 REP_1_HOST = HOST  # Default port number for replica 1
 REP_1_PORT = 8001  # Default host address for replica 1
@@ -12,7 +49,8 @@ REP_2_HOST = HOST  # Default port number for replica 2
 REP_2_PORT = 8002  # Default host address for replica 2
 
 # app.config related variables
-AUTO_READ_ON_SLAVE = True
+AUTO_READ_ON_SLAVE = True     # Serve read-only pages from the 'slave' bind, a replica kept in sync from the commit log
+REPLICA_QUEUE_LIMIT = 10000   # Commands waiting for the replica before it is copied from the primary instead
 SQLALCHEMY_DATABASE_URI = 'sqlite:///miniatureddit.db'
 SQLALCHEMY_DATABASE_REPLICA_URI = 'sqlite:///replica.db'
 SQLALCHEMY_TRACK_MODIFICATIONS = False # Silence the deprecation warning
@@ -23,4 +61,20 @@ SQLALCHEMY_BINDS = {
 
 SECRET_KEY = token_hex(16)
 
+# Password hashing, done in worker processes rather than on request threads
+PASSWORD_ROUNDS = 100000     # PBKDF2-SHA256 iterations; hashes made with other settings are upgraded at login
+PASSWORD_SALT_SIZE = 16      # Bytes of salt per hash
+PASSWORD_WORKERS = os.cpu_count() or 1  # Processes hashing passwords
+PASSWORD_QUEUE_LIMIT = 64    # Hashes waiting for a worker before further logins are turned away
+PASSWORD_TIMEOUT = 10        # Seconds a request waits for its hash
+
+# SQL instrumentation, served at /metrics in the Prometheus text format
+METRICS_ENABLED = True      # False leaves the database engines and requests uninstrumented
+SLOW_QUERY_SECONDS = 0.1    # Statements taking longer are counted as slow and printed
+
+POSTS_PER_PAGE = 20  # Posts shown per page of the front page and profile feeds
+FRAGMENT_CACHE_SIZE = 4096  # Rendered post cards/comments kept in memory; 0 disables the cache
+USER_CACHE_SIZE = 10000     # Users (id, username, join date) kept in memory for sessions and feeds; 0 disables the cache
+USER_CACHE_TTL = 300        # Seconds a cached user, or the absence of one, is trusted
+
 ILLEGAL_CHARS = ['~', '`', '!', '@', '#', '$', '%', '^', '&', '*', '(', ')', '-', '+', '=', '{', '}', '[', ']', '|', '\\', ':', ';', '"', '\'', '<', '>', ',', '.', '?', '/']
\ No newline at end of file
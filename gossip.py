@@ -1,51 +1,383 @@
+import hashlib
+import logging
+import os
+import random
 import threading
+import time
+from collections import deque
+from cache import fragments, users
+from channels import channels
+from commitlog import CommitLog
 from config import *
-from models import db
-from os import path
-from sqlalchemy import text
+from heartbeat import HeartbeatScheduler
+from hlc import LOGICAL_BITS, NODE_BITS, clock, node_bits
+from membership import Membership
+from metrics import (APPLY_SECONDS, COMMANDS_APPLIED, COMMANDS_BROADCAST, REPLICATION_DELAY,
+                     instrument_engine)
+from models import db, Comment, HighWater, Post, User, Vote
+from records import apply_changes, invalidate_cached
+from replication import Outbox
+from replica import ReadReplica
+from replication_db import open_replication_db
+from snapshot import (checksum, latest_snapshot, read_chunks, remove_snapshots,
+                      restore_snapshot, snapshot_high_water, snapshot_name, take_snapshot)
 
 import p2psync_pb2 as pb2
 import p2psync_pb2_grpc as pb2_grpc
 import grpc
 
+log = logging.getLogger(__name__)
+
+# Serializes changes to commit_counter, high_water and the commit log, so commit
+# numbers are appended in order and snapshots see a consistent commit number
+commit_lock = threading.Lock()
+
+# Follows the commit log into the read replica, if there is one
+replica = None
+
+
+def high_water_marks():
+    '''Copy of the highest seq applied from each origin, including our own writes'''
+    with commit_lock:
+        return dict(high_water)
+
+
+def commit_commands(commands, forward=False):
+    '''Apply replicated commands in one transaction, append them to the commit log
+       in one write and advance commit_counter and the high-water marks. With
+       forward=True, the commands that were new to us are gossiped on to
+       GOSSIP_FANOUT random peers; duplicates are not, so each command stops
+       spreading once the peers it reaches already have it.
+       Each origin's commands are applied in seq order without gaps: a command at
+       or below its origin's high-water mark is a duplicate (a retried batch, or
+       one we also got from another peer) and is skipped, and one beyond the next
+       seq is held back with the rest of its origin's commands, whose origins are
+       returned so the caller can fetch what is missing.'''
+    with commit_lock:
+        return commit_commands_locked(commands, forward)
+
+
+def commit_commands_locked(commands, forward=False):
+    '''commit_commands() for a caller that already holds commit_lock'''
+    global commit_counter
+    fresh, marks, gaps = [], {}, set()
+    for command in commands:
+        mark = marks.get(command.origin, high_water.get(command.origin, 0))
+        if command.seq <= mark:
+            continue
+        if command.seq > mark + 1 or command.origin in gaps:
+            gaps.add(command.origin)
+            continue
+        fresh.append(command)
+        marks[command.origin] = command.seq
+    if not fresh:
+        return gaps
+
+    # A snapshot can already hold rows written just before it was tagged;
+    # their inserts are ignored when replayed
+    start = time.perf_counter()
+    session = SESSION()
+    try:
+        changed = apply_changes([command.change for command in fresh], session)
+        HighWater.save(marks, session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        SESSION.remove()
+    invalidate_cached(changed)
+    APPLY_SECONDS.observe(time.perf_counter() - start)
+
+    # Renumber the commands by their position in our own commit log
+    entries = []
+    now = clock.physical()
+    for command in fresh:
+        COMMANDS_APPLIED.labels(command.origin).inc()
+        REPLICATION_DELAY.labels(command.origin).observe(max(now - command.hlc, 0) / (1000 << LOGICAL_BITS))
+        clock.update(command.hlc)
+        commit_counter += 1
+        entry = pb2.DatabaseCommand()
+        entry.CopyFrom(command)
+        entry.timestamp = commit_counter
+        entries.append(entry)
+    commit_log.append(entries)
+    high_water.update(marks)
+    if replica is not None:
+        replica.publish(entries)
+    # With a fan-out that covers every peer, the origin has already sent them the commands
+    if forward and GOSSIP_FANOUT < len(membership):
+        outbox.publish(membership.snapshot(), entries, GOSSIP_FANOUT, exclude={command.origin for command in entries})
+    return gaps
+
+
+def fetch_commands(host, port):
+    '''Fetch the peer's commands that are above our high-water marks'''
+    response_iterator = channels.stub(host, port).ListenCommands(pb2.CommandCursor(high_water=high_water_marks()))
+    return [command for batch in response_iterator for command in batch.commands]
+
+
+def receive_missing_commands(host, port):
+    '''Fetch the peer's commands that are above our high-water marks. If the peer has
+       truncated some of them into a snapshot, restore its snapshot first and then
+       fetch the rest of its log.'''
+    try:
+        return fetch_commands(host, port)
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.FAILED_PRECONDITION:
+            raise
+    with restore_lock:
+        receive_snapshot(host, port)
+    return fetch_commands(host, port)
+
+
+# One snapshot is downloaded and restored at a time, whichever peer it comes from
+restore_lock = threading.Lock()
+
+
+def receive_snapshot(host, port):
+    '''Replace the database with the peer's newest snapshot, verifying its checksum'''
+    global commit_counter, high_water
+    download = SNAPSHOT_PREFIX + '.download'
+    digest = hashlib.sha256()
+    commit, expected = None, None
+    with open(download, 'wb') as f:
+        for chunk in channels.stub(host, port).ListenSnapshot(pb2.Empty()):
+            f.write(chunk.data)
+            digest.update(chunk.data)
+            commit, expected = chunk.commit, chunk.sha256
+    if commit is None or digest.hexdigest() != expected:
+        os.remove(download)
+        raise Exception("Snapshot from peer failed its checksum.")
+
+    filename = snapshot_name(SNAPSHOT_PREFIX, commit)
+    os.replace(download, filename)
+    with commit_lock:
+        restore_snapshot(ENGINE, filename)
+        with CONTEXT:
+            db.engine.dispose()  # The web app's pooled connections may hold pages of the old database
+        users.clear()
+        fragments.clear()
+        try:
+            high_water = HighWater.load(SESSION())
+        finally:
+            SESSION.remove()
+        # The peer may not have all of our own writes yet: apply the ones our old
+        # log holds on top of the snapshot, and never hand out a seq twice
+        missing = list(commit_log.read_after(high_water))
+        commit_log.reset(commit, high_water)
+        commit_counter = commit
+        for i in range(0, len(missing), APPLY_BATCH_SIZE):
+            commit_commands_locked(missing[i:i + APPLY_BATCH_SIZE])
+        high_water[NODE_ID] = max(high_water.get(NODE_ID, 0), commit_log.own_seq)
+        if replica is not None:
+            replica.invalidate()
+    remove_snapshots(SNAPSHOT_PREFIX, keep=filename)
+
+
+# Peers we are fetching missing commands from, so each gap starts one fetch
+catching_up = set()
+catching_up_lock = threading.Lock()
+
+
+def catch_up(address):
+    '''Fetch and apply the commands that the peer at "host:port" has and we do not,
+       e.g. because its outbox dropped commands while we were away'''
+    with catching_up_lock:
+        if address in catching_up:
+            return
+        catching_up.add(address)
+    try:
+        host, port = address.rsplit(':', 1)
+        commands = receive_missing_commands(host, port)
+        for i in range(0, len(commands), APPLY_BATCH_SIZE):
+            commit_commands(commands[i:i + APPLY_BATCH_SIZE])
+    except Exception:
+        log.warning('Could not catch up with %s', address, exc_info=True)
+    finally:
+        with catching_up_lock:
+            catching_up.discard(address)
+
+
+def remove_peer(peer):
+    '''Drop a peer the failure detector declared dead and tell the other peers, unless
+       it is already gone (e.g. another node reported it first)'''
+    version = membership.remove(peer.host, peer.port)
+    if version is None:
+        return
+    channels.close(peer.host, peer.port)
+    broadcast_peer_update(membership.snapshot(), peer, False, version)
+
+
+def broadcast_peer_update(peers, peer, add, version):
+    '''Broadcast peer update for Peer peer depending on
+       whether or not it was added (add=True) or removed (add=False)'''
+    for p in peers:
+        try:
+            channels.stub(p.host, p.port).PeerListUpdate(pb2.PeerUpdate(peer=peer, add=add, version=version),
+                                                         timeout=REPLICATION_RPC_TIMEOUT)
+        except grpc.RpcError:
+            pass  # An unreachable peer is removed by its own failure detection
+
+
+def colliding_node(node_id, peers):
+    '''The node among us and `peers` whose row ids would share their low bits with
+       those of node_id, a "host:port" other than theirs, or None. Writes from two
+       such nodes in the same millisecond would get the same ids.'''
+    bits = node_bits(node_id)
+    for other in [NODE_ID] + [f'{peer.host}:{peer.port}' for peer in peers]:
+        if other != node_id and node_bits(other) == bits:
+            return other
+    return None
+
+
+def ahead_of(theirs, mine):
+    '''Whether high-water marks `theirs` include commands that `mine` do not'''
+    return any(seq > mine.get(origin, 0) for origin, seq in theirs.items())
+
+
+class CommandApplier:
+    '''Group commit for the commands peers push to us: SendCommands calls that
+       arrive while a transaction is being applied wait and are applied together
+       in the next one, up to APPLY_BATCH_SIZE commands, instead of each paying
+       for its own commit.'''
+    def __init__(self):
+        self.pending = deque()
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, commands):
+        '''Apply the commands, in order; returns once they are committed, with the
+           origins of any commands held back by a gap'''
+        request = {'commands': list(commands), 'done': threading.Event(), 'error': None, 'gaps': set()}
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['gaps']
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                requests = [self.pending.popleft()]
+                size = len(requests[0]['commands'])
+                while self.pending and size + len(self.pending[0]['commands']) <= APPLY_BATCH_SIZE:
+                    size += len(self.pending[0]['commands'])
+                    requests.append(self.pending.popleft())
+
+            try:
+                gaps = commit_commands([command for request in requests for command in request['commands']], forward=True)
+                for request in requests:
+                    request['gaps'] = gaps & {command.origin for command in request['commands']}
+            except Exception as e:
+                if len(requests) == 1:
+                    requests[0]['error'] = e
+                else:
+                    # Keep one bad request from failing the others it was grouped with
+                    for request in requests:
+                        try:
+                            request['gaps'] = commit_commands(request['commands'], forward=True)
+                        except Exception as e:
+                            request['error'] = e
+            for request in requests:
+                request['done'].set()
+
+
 class GossipProtocol:
-    def __init__(self, self_ip, self_port, other_ip, other_port, session, context):
-        global SESSION
-        SESSION = session
+    def __init__(self, self_ip, self_port, other_ip, other_port, context):
+        # Replicated writes go through a connection pool and sessions of our own;
+        # the web app's context is only entered to reset its engine after a restore
         global CONTEXT
         CONTEXT = context
+        global ENGINE, SESSION
+        with CONTEXT:
+            ENGINE, SESSION = open_replication_db(db.engine)
+        if METRICS_ENABLED:
+            instrument_engine(ENGINE, 'replication')
 
-        global COMMIT_LOG_FILE
-        COMMIT_LOG_FILE = f'commit_{self_ip}_{self_port}.txt'
+        # Our origin id in replicated commands; also tells apart the row ids we create
+        global NODE_ID
+        NODE_ID = f'{self_ip}:{self_port}'
+        clock.set_node(NODE_ID)
 
-        # Sets up a UDP socket listener on a specified port
-        global peers
-        stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{other_ip}:{other_port}'))
-        peers = \
-            [pb2.Peer(host=other_ip, port=other_port)] + list(stub.RequestPeerList(pb2.Peer(host=self_ip, port=str(self_port))).peers) \
-            if not (other_ip is None or other_port is None) \
-            else []
+        global COMMIT_LOG_FILE
+        COMMIT_LOG_FILE = f'commit_{self_ip}_{self_port}.log'
+        global SNAPSHOT_PREFIX
+        SNAPSHOT_PREFIX = f'snapshot_{self_ip}_{self_port}'
+
+        # Start from the peer we connected to and the peers it knows
+        global membership
+        membership = Membership(NODE_ID)
+        if not (other_ip is None or other_port is None):
+            membership.add(other_ip, other_port)
+            for peer in channels.stub(other_ip, other_port).RequestPeerList(pb2.Peer(host=self_ip, port=str(self_port))).peers:
+                membership.add(peer.host, peer.port)
+            # The peer we connected to checked its own members; another may have joined elsewhere meanwhile
+            other = colliding_node(NODE_ID, membership.snapshot())
+            if other is not None:
+                raise Exception(f'Row ids made by this node would collide with those of {other}. Use another port.')
 
         # Stop flag
         self.stop_flag = False
 
-        # Get the last commit number
+        # Background senders that replicate our commands to each peer
+        global outbox
+        outbox = Outbox(NODE_ID)
+
+        # Applies the commands that peers send us, a transaction per batch
+        global applier
+        applier = CommandApplier()
+
+        # Open the commit log, which starts after our newest snapshot, and get the last commit number
+        global commit_log
+        snapshot_file, base = latest_snapshot(SNAPSHOT_PREFIX)
+        commit_log = CommitLog(COMMIT_LOG_FILE, base=base, floor=snapshot_high_water(snapshot_file), origin=NODE_ID)
         global commit_counter
-        commit_counter = 0
-        if path.exists(COMMIT_LOG_FILE):
-            with open(COMMIT_LOG_FILE, "r") as f:
-                commit_counter = int(f.readlines()[-1].split("|")[0])
-        else:
-            open(COMMIT_LOG_FILE, 'w').close()
+        commit_counter = commit_log.last_commit
+
+        # What we have applied from each origin is in the database; our own last seq
+        # is in the commit log's header, which outlives truncation into a snapshot
+        global high_water
+        session = SESSION()
+        try:
+            high_water = HighWater.load(session)
+            # Keep the clock ahead of every row id we hold, even if the wall clock went back
+            clock.update(max(session.scalar(db.select(db.func.max(model.id))) or 0
+                             for model in (User, Post, Comment, Vote)) >> NODE_BITS)
+        finally:
+            SESSION.remove()
+        high_water[NODE_ID] = max(high_water.get(NODE_ID, 0), commit_log.own_seq)
 
         # Update current commit log with any of the other peers' commit logs
-        if peers:
+        if len(membership):
             self.load_commits()
 
+        # Serve read-only pages from a replica that follows the commit log from here on
+        global replica
+        with CONTEXT:
+            if AUTO_READ_ON_SLAVE and 'slave' in db.engines:
+                replica_engine, replica_session = open_replication_db(db.engines['slave'])
+                if METRICS_ENABLED:
+                    instrument_engine(replica_engine, 'replica')
+                replica = ReadReplica(ENGINE, replica_engine, replica_session, commit_lock, lambda: commit_counter)
+
+        # Periodically snapshot the database and truncate the commit log behind it
+        threading.Thread(target=self.snapshot_loop, daemon=True).start()
+
+        # Periodically compare digests with a random peer and fetch whatever we missed
+        threading.Thread(target=self.anti_entropy_loop, daemon=True).start()
+
+        # Heartbeat every peer, and remove the ones the failure detector finds dead
+        global heartbeats
+        heartbeats = HeartbeatScheduler(membership.snapshot, remove_peer, membership.seen)
+
 
     def load_commits(self):
-        global peers
-        for peer in peers:
+        for peer in membership.snapshot():
             try:
                 new_logs = self.receive_commit_log(peer)
             except grpc._channel._InactiveRpcError:
@@ -64,99 +396,163 @@ class GossipProtocol:
 
 
     def receive_commit_log(self, peer):
-        # Receive commit log from peer
-        global commit_counter
+        # Receive commit log from peer, starting from its snapshot if it truncated commits we are missing
         try:
-            host, port = peer.host, peer.port
-            stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{host}:{port}'))
-            response_iterator = stub.ListenCommands(pb2.Peer(host=host, port=port))
-
-            new_logs = []
-            counter = commit_counter
-            for res in response_iterator:
-                timestamp, command = res.timestamp, res.command
-
-                if int(timestamp) > counter:
-                    # Add the commit to the list of new commits
-                    new_logs.append(f'{timestamp}|{command[:-1]}')
-
-                    # Update the counter variable
-                    counter = int(timestamp)
-
-            return new_logs
-
+            return receive_missing_commands(peer.host, peer.port)
         except Exception:
-            print("Could not receive file.")
+            log.warning('Could not receive the commit log from %s:%s', peer.host, peer.port, exc_info=True)
             return None
 
 
     def update_database(self, new_logs):
         '''Get the database up to date with the commit log,
-        starting from the last commit number, commit_counter'''
-        global commit_counter
-        for line in new_logs:
-            commit_num, commit = line.split("|")
-            if int(commit_num) > commit_counter:
-                # Execute the commit
-                with CONTEXT:
-                    SESSION.execute(text(commit))
-                    SESSION.commit()
-                # Update the counter
-                with open(COMMIT_LOG_FILE, "a") as f:
-                    f.write(f"{str(commit_num)}|{commit}\n")
-                commit_counter = int(commit_num)
-
-
-    def broadcast(self, command):
-        '''Broadcasts a command to all peers in the network, and updates the commit log'''
+        skipping the commands at or below our high-water marks'''
+        for i in range(0, len(new_logs), APPLY_BATCH_SIZE):
+            commit_commands(new_logs[i:i + APPLY_BATCH_SIZE])
+
+
+    def broadcast(self, change):
+        '''Appends a change record to the commit log and queues it for GOSSIP_FANOUT random peers,
+           which gossip it on to the rest of the network. Returns its commit number once the log
+           entry is on disk; peers are sent the change in the background.'''
         global commit_counter
-        commit_counter += 1
-        with open(COMMIT_LOG_FILE, "a") as f:
-            f.write(f"{commit_counter}|{command}\n")
+        with commit_lock:
+            commit_counter += 1
+            high_water[NODE_ID] += 1
+            command = pb2.DatabaseCommand(timestamp=commit_counter, change=change, origin=NODE_ID,
+                                          seq=high_water[NODE_ID], hlc=clock.now())
+            commit_log.append([command], sync=True)
+            COMMANDS_BROADCAST.inc()
+            if replica is not None:
+                replica.publish([command])
+
+            # Queue in commit order, so each peer receives the commands in order
+            outbox.publish(membership.snapshot(), [command], GOSSIP_FANOUT)
+            return command.timestamp
+
+
+    def snapshot_loop(self):
+        while not self.stop_flag:
+            time.sleep(SNAPSHOT_INTERVAL)
+            if commit_counter - commit_log.base >= SNAPSHOT_MIN_COMMITS:
+                self.snapshot()
+
+
+    def anti_entropy_loop(self):
+        while not self.stop_flag:
+            # Jitter keeps the nodes from all syncing at the same moment
+            time.sleep(ANTI_ENTROPY_INTERVAL * random.uniform(0.5, 1.5))
+            peers = membership.snapshot()
+            if peers:
+                self.anti_entropy(random.choice(peers))
+
+
+    def anti_entropy(self, peer):
+        '''Exchange digests with a peer; pull the commands it has that we do not, and
+           let it pull the ones we have that it does not. Commands missed while a
+           peer was unreachable reach it within a few rounds.'''
+        mine = high_water_marks()
+        try:
+            theirs = channels.stub(peer.host, peer.port).ExchangeDigest(
+                pb2.Digest(high_water=mine, sender=NODE_ID), timeout=REPLICATION_RPC_TIMEOUT)
+        except grpc.RpcError as e:
+            log.warning('Could not exchange digests with %s:%s: %s', peer.host, peer.port, e.code())
+            return
+        membership.digest(f'{peer.host}:{peer.port}', theirs.high_water, mine)
+        if ahead_of(theirs.high_water, mine):
+            # Restores the peer's snapshot first if it has truncated what we are missing
+            catch_up(f'{peer.host}:{peer.port}')
+
+
+    def snapshot(self):
+        '''Snapshot the database, tagged with the last commit it includes, and
+           truncate the commit log up to that commit'''
+        with commit_lock:
+            commit = commit_counter
+            filename = snapshot_name(SNAPSHOT_PREFIX, commit)
+            # Peers that restore the snapshot learn our own seq from it
+            session = SESSION()
+            try:
+                HighWater.save({NODE_ID: high_water[NODE_ID]}, session)
+                session.commit()
+            finally:
+                SESSION.remove()
+            take_snapshot(ENGINE, filename)
+            commit_log.truncate(commit, high_water)
+        remove_snapshots(SNAPSHOT_PREFIX, keep=filename)
+
+
+    def replication_status(self):
+        '''Local commit counter and high-water marks, and queue depth and replication lag for each peer'''
+        return {'node_id': NODE_ID, 'commit_counter': commit_counter, 'high_water': high_water_marks(),
+                'commit_log_bytes': os.path.getsize(COMMIT_LOG_FILE),
+                'peers': outbox.stats(), 'channels': channels.health(), 'heartbeats': heartbeats.stats(),
+                'membership': membership.stats(), 'replica': replica.stats() if replica is not None else None}
 
-        # Broadcast to all peers
-        for p in peers:
-            host, port = p.host, p.port
-            stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{host}:{port}'))
-            stub.SendCommand(pb2.DatabaseCommand(timestamp=int(commit_counter), command=command))
+
+    def replica_caught_up(self, commit):
+        '''Whether the read replica exists and has applied every commit up to `commit`'''
+        return replica is not None and replica.caught_up(commit)
 
 
     def stop(self):
         self.stop_flag = True
+        heartbeats.stop()
+        if replica is not None:
+            replica.stop()
+        outbox.stop()
+        channels.close_all()
 
 
 class P2PSyncServer(pb2_grpc.P2PSyncServicer):
     def PeerListUpdate(self, request, context):
         """Send stream of peer lists to client"""
         peer, add = request.peer, request.add
-        global peers
-        if add:
-            peers.append(peer)
-        else:
-            peers.remove(peer)
+        # Several nodes may report the same change, and updates may arrive out of order
+        if membership.apply(peer.host, peer.port, add, request.version or None) is not None and not add:
+            channels.close(peer.host, peer.port)
 
         return pb2.Empty()
 
 
     def ListenCommands(self, request, context):
-        """Continually send stream of items from commit log to client"""
-        global COMMIT_LOG_FILE
-        with open(COMMIT_LOG_FILE, 'r') as commit_log:
-            for line in commit_log.readlines():
-                timestamp, command = line.split('|')
-                yield pb2.DatabaseCommand(timestamp=int(timestamp), command=command)
+        """Stream the commands above the client's high-water marks to it, in batches"""
+        marks = dict(request.high_water)
+        if not commit_log.covers(marks):
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, 'Commits were truncated; fetch the snapshot first')
+        batch = []
+        for command in commit_log.read_after(marks):
+            batch.append(command)
+            if len(batch) == LISTEN_BATCH_SIZE:
+                yield pb2.CommandBatch(commands=batch)
+                batch = []
+        if batch:
+            yield pb2.CommandBatch(commands=batch)
+
+
+    def ListenSnapshot(self, request, context):
+        """Stream our newest snapshot to the client in chunks, with its checksum"""
+        filename, commit = latest_snapshot(SNAPSHOT_PREFIX)
+        if filename is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'No snapshot')
+        digest = checksum(filename)
+        for data in read_chunks(filename):
+            yield pb2.SnapshotChunk(commit=commit, data=data, sha256=digest)
 
 
     def Connect(self, request, context):
         '''Receive connection from other P2PNode'''
         host, port = request.host, request.port
         peer = pb2.Peer(host=host, port=port)
-        global peers
-        self.broadcast_peer_update(peers, peer, True)
-        peers.append(peer)
-
-        # Start continuous heartbeat with new peer node
-        threading.Thread(target=self.heartbeat_peer, args=(host, port,)).start()
+        other = colliding_node(f'{host}:{port}', membership.snapshot())
+        if other is not None:
+            context.abort(grpc.StatusCode.ALREADY_EXISTS,
+                          f'Row ids made by {host}:{port} would collide with those of {other}; use another port')
+        # Announced even if we already had the peer, since others may have removed it.
+        # The heartbeat scheduler gives it HEARTBEAT_JOIN_GRACE seconds to start its server.
+        version = clock.now()
+        broadcast_peer_update(membership.snapshot(), peer, True, version)
+        membership.add(host, port, version)
 
         return pb2.Empty()
 
@@ -167,53 +563,49 @@ class P2PSyncServer(pb2_grpc.P2PSyncServicer):
 
 
     def SendCommand(self, request, context):
-        '''Register a command in the commit log and database if is greater than own commit counter'''
-        timestamp, command = request.timestamp, request.command
+        '''Register a command in the commit log and database unless it was already applied'''
+        self.catch_up_gaps(applier.submit([request]), None)
+        return pb2.Empty()
 
-        # If timestamp is greater than own commit counter, update commit log
-        global commit_counter
-        if timestamp > commit_counter:
-            # Execute the command
-            global CONTEXT
-            global SESSION
-            with CONTEXT:
-                SESSION.execute(text(command))
-                SESSION.commit()
-
-            # Update the counter
-            with open(COMMIT_LOG_FILE, "a") as f:
-                f.write(f"{timestamp}|{command}\n")
-            commit_counter = timestamp
 
+    def SendCommands(self, request, context):
+        '''Register a batch of commands from a peer's outbox, in order'''
+        self.catch_up_gaps(applier.submit(request.commands), request.sender)
         return pb2.Empty()
 
 
-    def RequestPeerList(self, request, context):
-        '''Initialize peer list of this node to that given in the input'''
-        global peers
-        return pb2.PeerList(peers=[x for x in peers if x != request])
+    def catch_up_gaps(self, origins, sender):
+        '''Fetch the commands we are missing when commands from some origins skipped
+           ahead: from the peer that sent them, which has everything before them, or
+           else from the peer most likely to have each origin's commands. The held
+           back commands are fetched again with the rest, from the peer's snapshot
+           and log if it has compacted the ones before them.'''
+        for address in ([sender] if sender and origins else {membership.source_for(origin) for origin in origins}):
+            threading.Thread(target=catch_up, args=(address,), daemon=True).start()
 
 
-    def heartbeat_peer(self, host, port):
-        '''Continuous heartbeat to peer at (host, port)'''
-        stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{host}:{port}'))
-        while True:
-            try:
-                stub.Heartbeat(pb2.Empty())
-            except grpc._channel._InactiveRpcError:
-                break
+    def ExchangeDigest(self, request, context):
+        '''Reply with our digest, and fetch what the sender has that we do not'''
+        mine = high_water_marks()
+        membership.digest(request.sender, request.high_water, mine)
+        if ahead_of(request.high_water, mine):
+            threading.Thread(target=catch_up, args=(request.sender,), daemon=True).start()
+        return pb2.Digest(high_water=mine, sender=NODE_ID)
 
-        # Remove peer if heartbeat fails
-        global peers
-        peer = pb2.Peer(host=host, port=port)
-        peers.remove(peer)
-        self.broadcast_peer_update(peers, peer, False)
 
+    def Status(self, request, context):
+        '''Replication progress of this node and what it knows of each peer'''
+        states, queues = heartbeats.stats(), outbox.stats()
+        peers = []
+        for address, info in membership.stats()['peers'].items():
+            queue = queues.get(address, {})
+            peers.append(pb2.PeerStatus(address=address, state=states.get(address, {}).get('state', ''),
+                                        queue_depth=queue.get('queue_depth', 0), lag_seconds=queue.get('lag_seconds', 0.0),
+                                        behind=info['behind'], seconds_since_seen=info['seconds_since_seen']))
+        return pb2.NodeStatus(node_id=NODE_ID, commit_counter=commit_counter, high_water=high_water_marks(),
+                              commit_log_bytes=os.path.getsize(COMMIT_LOG_FILE), peers=peers)
 
-    def broadcast_peer_update(self, peers, peer, add):
-        '''Broadcast peer update for Peer peer depending on
-           whether or not it was added (add=True) or removed (add=False)'''
-        for p in peers:
-            host, port = p.host, p.port
-            stub = pb2_grpc.P2PSyncStub(grpc.insecure_channel(f'{host}:{port}'))
-            stub.PeerListUpdate(pb2.PeerUpdate(peer=peer, add=add))
\ No newline at end of file
+
+    def RequestPeerList(self, request, context):
+        '''Initialize peer list of this node to that given in the input'''
+        return pb2.PeerList(peers=[x for x in membership.snapshot() if x != request])
@@ -0,0 +1,116 @@
+import math
+import random
+import threading
+import time
+from collections import deque
+
+from channels import channels
+from config import (HEARTBEAT_DEAD_PHI, HEARTBEAT_INTERVAL, HEARTBEAT_JITTER, HEARTBEAT_JOIN_GRACE,
+                    HEARTBEAT_SUSPECT_PHI, HEARTBEAT_TIMEOUT, HEARTBEAT_WINDOW)
+from metrics import RPC_FAILURES, RPC_SECONDS
+
+import p2psync_pb2 as pb2
+
+ALIVE, SUSPECT, DEAD = 'ALIVE', 'SUSPECT', 'DEAD'
+
+
+class FailureDetector:
+    '''Phi accrual failure detector for one peer. Rather than a fixed timeout, it
+       gives a suspicion level phi that grows the longer the peer has been silent,
+       relative to how often its replies usually arrive. With the gaps between
+       replies modelled as exponentially distributed, phi = -log10 of the chance
+       that a live peer stays silent this long: phi 3 is a 1 in 1000 chance.'''
+    def __init__(self, now):
+        self.added = now
+        self.last = None                                # When the last reply arrived
+        self.gaps = deque(maxlen=HEARTBEAT_WINDOW)      # Seconds between recent replies
+
+    def heartbeat(self, now):
+        if self.last is not None:
+            self.gaps.append(now - self.last)
+        self.last = now
+
+    def phi(self, now):
+        if self.last is None:
+            return 0.0
+        mean = sum(self.gaps) / len(self.gaps) if self.gaps else HEARTBEAT_INTERVAL
+        return (now - self.last) / mean * math.log10(math.e)
+
+    def state(self, now):
+        if self.last is None:
+            # Never heard from: it may still be loading the database before starting its server
+            return DEAD if now - self.added > HEARTBEAT_JOIN_GRACE else SUSPECT
+        phi = self.phi(now)
+        return DEAD if phi >= HEARTBEAT_DEAD_PHI else SUSPECT if phi >= HEARTBEAT_SUSPECT_PHI else ALIVE
+
+
+class HeartbeatScheduler:
+    '''Heartbeats every peer from one thread, each every HEARTBEAT_INTERVAL seconds
+       give or take HEARTBEAT_JITTER, so nodes do not all ping at the same moment.
+       Heartbeats are asynchronous calls, so a slow peer does not hold up the
+       others. When a peer's failure detector reaches DEAD, on_dead(peer) is called
+       once, from the scheduler thread, and on_seen(host, port) on every reply;
+       peers that leave the list are forgotten.'''
+    def __init__(self, peers, on_dead, on_seen):
+        self.peers = peers  # Returns the current pb2.Peers
+        self.on_dead = on_dead
+        self.on_seen = on_seen
+        self.detectors = {}  # (host, port) -> FailureDetector
+        self.due = {}        # (host, port) -> time.monotonic() of the next heartbeat
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            dead, send = [], []
+            with self.lock:
+                current = {(peer.host, peer.port): peer for peer in self.peers()}
+                for key in list(self.detectors):
+                    if key not in current:
+                        del self.detectors[key], self.due[key]
+                for key, peer in current.items():
+                    if key not in self.detectors:
+                        self.detectors[key], self.due[key] = FailureDetector(now), now
+                    if self.detectors[key].state(now) == DEAD:
+                        del self.detectors[key], self.due[key]
+                        dead.append(peer)
+                    elif self.due[key] <= now:
+                        self.due[key] = now + HEARTBEAT_INTERVAL * random.uniform(1 - HEARTBEAT_JITTER, 1 + HEARTBEAT_JITTER)
+                        send.append(key)
+                wake = min(self.due.values(), default=now + HEARTBEAT_INTERVAL)
+
+            for key in send:
+                self.send(key)
+            for peer in dead:
+                self.on_dead(peer)
+            self.stopped.wait(max(wake - time.monotonic(), 0))
+
+    def send(self, key):
+        start = time.monotonic()
+        future = channels.stub(*key).Heartbeat.future(pb2.Empty(), timeout=HEARTBEAT_TIMEOUT)
+        future.add_done_callback(lambda future: self.on_reply(key, future, start))
+
+    def on_reply(self, key, future, start):
+        peer = '{}:{}'.format(*key)
+        if future.exception() is not None:
+            RPC_FAILURES.labels(peer, 'Heartbeat').inc()
+            return  # A missed heartbeat; the detector notices the silence
+        RPC_SECONDS.labels(peer, 'Heartbeat').observe(time.monotonic() - start)
+        with self.lock:
+            detector = self.detectors.get(key)
+            if detector is not None:
+                detector.heartbeat(time.monotonic())
+        self.on_seen(*key)
+
+    def stats(self):
+        '''Failure detector state and phi of each peer, keyed by "host:port"'''
+        now = time.monotonic()
+        with self.lock:
+            return {f'{host}:{port}': {'state': detector.state(now), 'phi': round(detector.phi(now), 2)}
+                    for (host, port), detector in self.detectors.items()}
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,53 @@
+import hashlib
+import threading
+import time
+
+LOGICAL_BITS = 12          # Events per millisecond before the clock runs ahead of real time
+NODE_BITS = 10             # Low bits of a row id that tell apart nodes creating rows at the same instant
+EPOCH_MS = 1672531200000   # 2023-01-01 UTC; keeps row ids within 63 bits for decades
+
+
+def node_bits(node_id):
+    '''The low bits of the row ids that the node "host:port" creates. Two nodes may
+       hash to the same bits, so a node whose bits a member already has is refused
+       when it joins (see Connect in gossip.py).'''
+    return int.from_bytes(hashlib.sha256(node_id.encode()).digest()[:4], 'big') % (1 << NODE_BITS)
+
+
+class HybridClock:
+    '''Hybrid logical clock: milliseconds of wall time shifted left by LOGICAL_BITS,
+       plus a counter for events within the same millisecond. Every timestamp it
+       hands out is later than every one it has handed out or been shown, so an
+       event caused by a replicated write is ordered after that write even if
+       this node's wall clock is behind.'''
+    def __init__(self):
+        self.last = 0
+        self.node = 0
+        self.lock = threading.Lock()
+
+    def physical(self):
+        return (int(time.time() * 1000) - EPOCH_MS) << LOGICAL_BITS
+
+    def now(self):
+        '''Timestamp for a local event'''
+        with self.lock:
+            self.last = max(self.last + 1, self.physical())
+            return self.last
+
+    def update(self, remote):
+        '''Take in a timestamp from another node (or our own database after a restart)'''
+        with self.lock:
+            self.last = max(self.last, remote)
+
+    def set_node(self, node_id):
+        self.node = node_bits(node_id)
+
+    def new_id(self):
+        '''Row id for a user, post, comment or vote created on this node. Nodes
+           create rows concurrently, so ids cannot come from autoincrement; these
+           are unique as long as no two nodes share both a timestamp and node bits.'''
+        return self.now() << NODE_BITS | self.node
+
+
+# Shared by the models (row ids) and the gossip protocol (replicated commands)
+clock = HybridClock()
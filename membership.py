@@ -0,0 +1,110 @@
+import threading
+import time
+
+from hlc import clock
+
+import p2psync_pb2 as pb2
+
+
+class PeerInfo:
+    '''What we know about one peer'''
+    def __init__(self, host, port, version):
+        self.host, self.port = host, port
+        self.version = version   # Clock reading of the update that added it
+        self.last_seen = None    # time.time() of its last heartbeat reply
+        self.high_water = {}     # Its high-water marks, as of the last digest we exchanged with it
+        self.behind = None       # Commands we had and it did not, as of that digest
+
+
+class Membership:
+    '''The peers of this node, keyed by (host, port) and guarded by a lock, since
+       gRPC handlers and background threads all read and change them.
+       Every add or remove carries a version, a hybrid clock reading. The version
+       of the last update is kept per address even after the peer is removed, and
+       older updates are ignored, so a late "add" cannot revive a peer whose
+       removal we already applied. On a tie the removal wins.'''
+    def __init__(self, self_address):
+        self.self_key = tuple(self_address.rsplit(':', 1))
+        self.members = {}     # (host, port) -> PeerInfo
+        self.versions = {}    # (host, port) -> version of the last update applied, removals included
+        self.version = 0      # Bumped on every change to the table
+        self.lock = threading.Lock()
+        self.peers = ()       # snapshot() of the current version
+
+    def apply(self, host, port, add, version=None):
+        '''Add or remove a peer, with the version of the update (a new clock reading if
+           None). Returns the version if the table changed, otherwise None.'''
+        key = (host, str(port))
+        if version is None:
+            version = clock.now()
+        else:
+            clock.update(version)
+        with self.lock:
+            known = self.versions.get(key, 0)
+            if key == self.self_key or version < known or (version == known and add):
+                return None
+            self.versions[key] = version
+            if add == (key in self.members):
+                if add:
+                    self.members[key].version = version
+                return None
+            if add:
+                self.members[key] = PeerInfo(*key, version)
+            else:
+                del self.members[key]
+            self.version += 1
+            self.peers = tuple(pb2.Peer(host=host, port=port) for host, port in self.members)
+            return version
+
+    def add(self, host, port, version=None):
+        return self.apply(host, port, True, version)
+
+    def remove(self, host, port, version=None):
+        return self.apply(host, port, False, version)
+
+    def snapshot(self):
+        '''The current peers, as an immutable tuple of pb2.Peer that later changes do
+           not affect; rebuilt only when the table changes'''
+        return self.peers
+
+    def __contains__(self, peer):
+        return (peer.host, str(peer.port)) in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def seen(self, host, port):
+        '''Record a heartbeat reply from a peer'''
+        with self.lock:
+            info = self.members.get((host, str(port)))
+            if info is not None:
+                info.last_seen = time.time()
+
+    def digest(self, address, theirs, mine):
+        '''Record a peer's high-water marks from a digest exchange, and how far behind ours they were'''
+        with self.lock:
+            info = self.members.get(tuple(address.rsplit(':', 1)))
+            if info is not None:
+                info.high_water = dict(theirs)
+                info.behind = sum(max(seq - theirs.get(origin, 0), 0) for origin, seq in mine.items())
+
+    def source_for(self, origin):
+        '''Address of the peer to fetch an origin's commands from: the origin itself if it
+           is a peer, else the one whose last digest showed the most of its commands'''
+        with self.lock:
+            if tuple(origin.rsplit(':', 1)) in self.members:
+                return origin
+            best = max(self.members.values(), key=lambda info: info.high_water.get(origin, 0), default=None)
+            if best is None or not best.high_water.get(origin):
+                return origin
+            return f'{best.host}:{best.port}'
+
+    def stats(self):
+        '''Table version, and when each peer was last seen and how far behind it was, keyed by "host:port"'''
+        now = time.time()
+        with self.lock:
+            return {'version': self.version,
+                    'peers': {f'{info.host}:{info.port}': {
+                        'seconds_since_seen': None if info.last_seen is None else round(now - info.last_seen, 1),
+                        'high_water': info.high_water, 'behind': info.behind}
+                              for info in self.members.values()}}
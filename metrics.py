@@ -0,0 +1,133 @@
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+from config import SLOW_QUERY_SECONDS
+
+# Statements are labelled with their source: the endpoint of the web request that
+# ran them, or else the name the engine was instrumented with (e.g. 'replication')
+STATEMENTS = Counter('sql_statements', 'SQL statements executed', ['source'])
+STATEMENT_SECONDS = Histogram('sql_statement_seconds', 'Time spent executing each SQL statement', ['source'],
+                              buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+SLOW_STATEMENTS = Counter('sql_slow_statements', f'SQL statements that took over {SLOW_QUERY_SECONDS}s', ['source'])
+REQUEST_STATEMENTS = Histogram('sql_statements_per_request', 'SQL statements per web request', ['route'],
+                               buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+REQUEST_SECONDS = Histogram('sql_seconds_per_request', 'Time spent in SQL per web request', ['route'],
+                            buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+# Replication: events are counted as they happen, while the state the replication
+# server already keeps (see ReplicationCollector) is read when the metrics are scraped
+COMMANDS_BROADCAST = Counter('p2p_commands_broadcast', 'Commands made on this node and appended to its commit log')
+COMMANDS_APPLIED = Counter('p2p_commands_applied', 'Replicated commands applied to the database', ['origin'])
+APPLY_SECONDS = Histogram('p2p_apply_seconds', 'Time to apply a batch of replicated commands in one transaction',
+                          buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+REPLICATION_DELAY = Histogram('p2p_replication_delay_seconds',
+                              'Time from a write on its origin until it is applied here, by hybrid clock', ['origin'],
+                              buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+RPC_SECONDS = Histogram('p2p_rpc_seconds', 'Latency of successful RPCs to peers', ['peer', 'method'],
+                        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+RPC_FAILURES = Counter('p2p_rpc_failures', 'RPCs to peers that failed or timed out', ['peer', 'method'])
+
+
+class ReplicationCollector:
+    '''Gauges read from GossipProtocol.replication_status() on every scrape'''
+    def __init__(self, status):
+        self.status = status
+
+    def collect(self):
+        status = self.status()
+        yield GaugeMetricFamily('p2p_commit_counter', 'Commands in this node\'s commit log, snapshots included',
+                                value=status['commit_counter'])
+        yield GaugeMetricFamily('p2p_commit_log_bytes', 'Size of the commit log file since the last snapshot',
+                                value=status['commit_log_bytes'])
+        high_water = GaugeMetricFamily('p2p_high_water', 'Highest seq applied from each origin', labels=['origin'])
+        for origin, seq in status['high_water'].items():
+            high_water.add_metric([origin], seq)
+        yield high_water
+
+        queued = GaugeMetricFamily('p2p_peer_queue_depth', 'Commands waiting in the outbox for each peer', labels=['peer'])
+        unacked = GaugeMetricFamily('p2p_peer_lag_seconds', 'Age of the oldest command each peer has not acknowledged',
+                                    labels=['peer'])
+        for peer, stats in status['peers'].items():
+            queued.add_metric([peer], stats['queue_depth'])
+            unacked.add_metric([peer], stats['lag_seconds'])
+        behind = GaugeMetricFamily('p2p_peer_behind_commands',
+                                   'Commands this node had and each peer did not, at their last digest exchange',
+                                   labels=['peer'])
+        silent = GaugeMetricFamily('p2p_peer_seconds_since_seen', 'Seconds since each peer last answered a heartbeat',
+                                   labels=['peer'])
+        for peer, info in status['membership']['peers'].items():
+            if info['behind'] is not None:
+                behind.add_metric([peer], info['behind'])
+            if info['seconds_since_seen'] is not None:
+                silent.add_metric([peer], info['seconds_since_seen'])
+        yield from (queued, unacked, behind, silent)
+
+
+def watch_replication(status):
+    '''Export the replication server's state, from its replication_status(), at /metrics'''
+    REGISTRY.register(ReplicationCollector(status))
+
+
+instrumented = set()  # Engines already listened to; in-memory databases share one between callers
+instrumented_lock = threading.Lock()
+
+
+def instrument_engine(engine, source):
+    '''Count and time every statement the engine executes. Slow ones are printed,
+       without their parameters, which may hold password hashes.'''
+    with instrumented_lock:
+        if engine in instrumented:
+            return
+        instrumented.add(engine)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context.metrics_start
+        label = source
+        if has_request_context():
+            label = request.endpoint or 'unmatched'
+            totals = g.get('sql_totals')
+            if totals is not None:
+                totals[0] += 1
+                totals[1] += seconds
+        STATEMENTS.labels(label).inc()
+        STATEMENT_SECONDS.labels(label).observe(seconds)
+        if seconds >= SLOW_QUERY_SECONDS:
+            SLOW_STATEMENTS.labels(label).inc()
+            print(f'Slow SQL statement from {label} took {seconds:.3f}s: {" ".join(statement.split())}')
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def start_request():
+    g.sql_totals = [0, 0.0]  # Statements, seconds
+
+
+def end_request(exception):
+    totals = g.pop('sql_totals', None)
+    if totals is not None:
+        route = request.endpoint or 'unmatched'
+        REQUEST_STATEMENTS.labels(route).observe(totals[0])
+        REQUEST_SECONDS.labels(route).observe(totals[1])
+
+
+def serve_metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, db):
+    '''Instrument the app's database engines and requests, and serve the metrics at
+       /metrics in the Prometheus text format. Call inside an app context.'''
+    for engine in db.engines.values():
+        instrument_engine(engine, 'web')
+    app.before_request(start_request)
+    app.teardown_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
@@ -1,12 +1,51 @@
+from flask import g
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
-from passlib.hash import pbkdf2_sha256
+from flask_sqlalchemy.session import Session
+from flask_login import LoginManager, UserMixin
 from datetime import datetime
+from math import log10
+
+from cache import users
+from hlc import clock
+from passwords import hasher
+
+
+class RoutingSession(Session):
+    '''Sends the queries of a request that may read from the replica (g.read_replica,
+       set by app.py's read_only) to the 'slave' bind, and everything else, flushes
+       included, to the primary'''
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if g.get('read_replica') and not self._flushing:
+            return db.engines['slave']
+        return super().get_bind(mapper, clause, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Reference point for the hot ranking; only differences between posts matter
+HOT_EPOCH = datetime(2005, 12, 8, 7, 46, 43)
+
+
+def hot_rank(score, date_posted):
+    '''Reddit's hot ranking: the order of magnitude of the score, plus a term that
+       grows by one every 12.5 hours so that newer posts overtake older ones'''
+    order = log10(max(abs(score), 1))
+    sign = 1 if score > 0 else -1 if score < 0 else 0
+    seconds = (date_posted - HOT_EPOCH).total_seconds()
+    return round(sign * order + seconds / 45000, 7)
+
+
+def controversy_rank(upvotes, downvotes):
+    '''Reddit's controversial ranking: many votes, split as evenly as possible'''
+    if upvotes <= 0 or downvotes <= 0:
+        return 0
+    magnitude = upvotes + downvotes
+    balance = downvotes / upvotes if upvotes > downvotes else upvotes / downvotes
+    return magnitude ** balance
 
-db = SQLAlchemy()
 
 class User(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, default=clock.new_id)
     username = db.Column(db.String(64), nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     posts = db.relationship('Post', backref='author', lazy=True)
@@ -27,17 +66,81 @@ class User(db.Model):
         return str(self.id)
 
     def set_password(self, password):
-        self.password_hash = pbkdf2_sha256.encrypt(password, rounds=100000, salt_size=16)
-        db.session.commit()
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return pbkdf2_sha256.verify(password, self.password_hash)
+        '''Whether the password matches. A hash made with other settings than the current
+           PASSWORD_ROUNDS and PASSWORD_SALT_SIZE is replaced with a new one; the caller commits.'''
+        matches, upgraded = hasher.verify(password, self.password_hash)
+        if upgraded is not None:
+            self.password_hash = upgraded
+        return matches
+
+    def __repr__(self):
+        return '<user/{}>'.format(self.username)
+
+
+class CachedUser(UserMixin):
+    '''The parts of a User that sessions and feeds need. It belongs to no database
+       session, so one instance can be shared by every request from the user cache.'''
+    def __init__(self, id, username, date_created):
+        self.id = id
+        self.username = username
+        self.date_created = date_created
 
     def __repr__(self):
         return '<user/{}>'.format(self.username)
+
+
+def load_users(user_ids):
+    '''user id -> CachedUser for the given ids that exist, in one query'''
+    rows = db.session.execute(
+        db.select(User.id, User.username, User.date_created).where(User.id.in_(user_ids)))
+    return {row.id: CachedUser(*row) for row in rows}
+
+
+def cached_users(user_ids):
+    '''user id -> CachedUser, or None if there is no such user, through the user cache'''
+    return users.get_many(user_ids, load_users)
+
+
+def cached_user(user_id):
+    return cached_users([user_id])[user_id]
+
+
+class VoteTally:
+    '''Vote counters kept in step with the Vote table, so rendering needs no COUNT queries'''
+    upvotes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    downvotes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    score = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def tally_vote(self, is_upvote, delta):
+        '''Add (delta=1) or retract (delta=-1) a vote; the caller commits. The counters are
+           incremented in SQL rather than written back from Python, so concurrent votes
+           do not overwrite each other; the rankings are then computed from the stored counts.'''
+        model = type(self)
+        if is_upvote:
+            self.upvotes = model.upvotes + delta
+            self.score = model.score + delta
+        else:
+            self.downvotes = model.downvotes + delta
+            self.score = model.score - delta
+        db.session.flush()
+        self.refresh_rank()
+
+    def refresh_rank(self):
+        '''Recompute any rankings derived from the counters'''
+        pass
+
+    def get_upvotes(self):
+        return self.upvotes
+
+    def get_downvotes(self):
+        return self.downvotes
+
     
-class Post(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class Post(VoteTally, db.Model):
+    id = db.Column(db.Integer, primary_key=True, default=clock.new_id)
     title = db.Column(db.String(64), nullable=False)
     content = db.Column(db.Text, nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -46,20 +149,85 @@ class Post(db.Model):
     deleted = db.Column(db.Boolean, default=False)
     comments = db.relationship('Comment', backref='post', lazy=True)
     votes = db.relationship('Vote', backref='post', lazy='dynamic')
+    # Precomputed rankings, refreshed whenever the vote counters change
+    hot = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    controversy = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        db.Index('ix_post_deleted_date', 'deleted', 'date_posted'),
+        db.Index('ix_post_author_deleted_date', 'author_id', 'deleted', 'date_posted'),
+        db.Index('ix_post_deleted_hot', 'deleted', 'hot'),
+        db.Index('ix_post_deleted_score', 'deleted', 'score'),
+        db.Index('ix_post_deleted_controversy', 'deleted', 'controversy'),
+    )
     
     def delete(self):
         self.deleted = True
         db.session.commit()
-        
-    def get_upvotes(self):
-        return self.votes.filter_by(is_upvote=True).count()
-    
-    def get_downvotes(self):
-        return self.votes.filter_by(is_upvote=False).count()
+
+    def refresh_rank(self):
+        self.hot = hot_rank(self.score or 0, self.date_posted or datetime.utcnow())
+        self.controversy = controversy_rank(self.upvotes or 0, self.downvotes or 0)
+
+    @staticmethod
+    def sort_column(sort):
+        '''The stored column a feed sort mode orders by: new, hot, top or controversial'''
+        return {
+            'hot': Post.hot,
+            'top': Post.score,
+            'controversial': Post.controversy,
+        }.get(sort, Post.date_posted)
+
+    def cursor(self, sort='new'):
+        '''Opaque position of this post in a feed, for the "next page" link'''
+        value = getattr(self, Post.sort_column(sort).key)
+        value = value.isoformat() if isinstance(value, datetime) else repr(value)
+        return f'{value}_{self.id}'
+
+    @staticmethod
+    def keyset_page(query, after, per_page, sort='new'):
+        '''Returns (posts, next_cursor) for the page of the query that follows the
+           cursor `after` (None for the first page), highest first in the sort
+           column. Seeks on (sort column, id) so the cost does not depend on how
+           deep the page is.'''
+        column = Post.sort_column(sort)
+        if after:
+            try:
+                value, post_id = after.rsplit('_', 1)
+                parse = datetime.fromisoformat if column is Post.date_posted else float
+                value, post_id = parse(value), int(post_id)
+            except ValueError:
+                pass  # A malformed cursor just shows the first page
+            else:
+                query = query.filter(db.or_(
+                    column < value,
+                    db.and_(column == value, Post.id < post_id),
+                ))
+
+        posts = query.order_by(column.desc(), Post.id.desc()).limit(per_page + 1).all()
+        if len(posts) > per_page:
+            return posts[:per_page], posts[per_page - 1].cursor(sort)
+        return posts, None
+
+    @staticmethod
+    def refresh_ranks(post_ids=None, session=db.session):
+        '''Recompute the stored rankings of the given posts, or of every post'''
+        query = db.select(Post.id, Post.upvotes, Post.downvotes, Post.score, Post.date_posted)
+        if post_ids is not None:
+            query = query.where(Post.id.in_(post_ids))
+        session.bulk_update_mappings(Post, [
+            {'id': row.id, 'hot': hot_rank(row.score, row.date_posted),
+             'controversy': controversy_rank(row.upvotes, row.downvotes)}
+            for row in session.execute(query)
+        ])
+
+
+@db.event.listens_for(Post, 'before_insert')
+def rank_new_post(mapper, connection, post):
+    post.refresh_rank()
     
 
-class Comment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class Comment(VoteTally, db.Model):
+    id = db.Column(db.Integer, primary_key=True, default=clock.new_id)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -76,16 +244,157 @@ class Comment(db.Model):
         
     def has_parent(self):
         return self.parent_id is not None
-    
-    def get_upvotes(self):
-        return self.votes.filter_by(is_upvote=True).count()
-    
-    def get_downvotes(self):
-        return self.votes.filter_by(is_upvote=False).count()
+
+    @staticmethod
+    def thread(post_id, max_depth=None):
+        '''Returns the comment trees of a post as {'comment': ..., 'children': [...]} dictionaries.
+           All comments come from a single query and are assembled in memory; roots are
+           newest first, replies oldest first. Replies deeper than max_depth (roots are
+           depth 0) are left out. Author names are not loaded: see cached_users().'''
+        comments = Comment.query.filter_by(post_id=post_id).order_by(Comment.id).all()
+
+        nodes = {comment.id: {'comment': comment, 'children': []} for comment in comments}
+        roots = []
+        for comment in comments:
+            parent = nodes.get(comment.parent_id)
+            if parent is None:
+                roots.append(nodes[comment.id])
+            else:
+                parent['children'].append(nodes[comment.id])
+        roots.sort(key=lambda node: node['comment'].date_posted, reverse=True)
+
+        if max_depth is not None:
+            def prune(node, depth):
+                if depth >= max_depth:
+                    node['children'] = []
+                for child in node['children']:
+                    prune(child, depth + 1)
+            for root in roots:
+                prune(root, 0)
+        return roots
 
 class Vote(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, default=clock.new_id)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     is_upvote = db.Column(db.Boolean, nullable=False)
+    __table_args__ = (
+        db.Index('ix_vote_user_post', 'user_id', 'post_id'),
+        db.Index('ix_vote_user_comment', 'user_id', 'comment_id'),
+    )
+
+    @staticmethod
+    def post_votes_by(user_id, post_ids):
+        '''Map each of the given post ids the user voted on to is_upvote, in one query'''
+        return Vote._votes_by(user_id, Vote.post_id, post_ids)
+
+    @staticmethod
+    def comment_votes_by(user_id, comment_ids):
+        '''Map each of the given comment ids the user voted on to is_upvote, in one query'''
+        return Vote._votes_by(user_id, Vote.comment_id, comment_ids)
+
+    @staticmethod
+    def _votes_by(user_id, key, content_ids):
+        content_ids = list(set(content_ids))
+        if not content_ids:
+            return {}
+        rows = db.session.execute(
+            db.select(key, Vote.is_upvote).where(Vote.user_id == user_id, key.in_(content_ids))
+        )
+        return {content_id: is_upvote for content_id, is_upvote in rows}
+
+    @staticmethod
+    def count_rows(vote_ids, delta, counts, session=db.session):
+        '''Add what stored vote rows count for, times delta, to `counts`:
+           {('post' or 'comment', id): [upvotes, downvotes]}, for apply_counts().
+           Used for replicated commands, which write the vote table directly.'''
+        rows = session.execute(
+            db.select(Vote.post_id, Vote.comment_id, Vote.is_upvote).where(Vote.id.in_(vote_ids)))
+        for row in rows:
+            # Votes on posts carry comment_id=-1, votes on comments carry post_id=-1
+            if row.comment_id is not None and row.comment_id != -1:
+                target = ('comment', row.comment_id)
+            else:
+                target = ('post', row.post_id)
+            counts.setdefault(target, [0, 0])[0 if row.is_upvote else 1] += delta
+
+    @staticmethod
+    def apply_counts(counts, session=db.session):
+        '''Add counts from count_rows() to the counters and refresh the rankings of the
+           posts they changed, returning the set of ('post' or 'comment', id) in `counts`'''
+        # One executemany per table, rather than loading and flushing each post or comment
+        for kind, model in (('post', Post), ('comment', Comment)):
+            params = [{'target': content_id, 'up': up, 'down': down}
+                      for (target_kind, content_id), (up, down) in counts.items()
+                      if target_kind == kind and (up or down)]
+            if params:
+                table = model.__table__
+                session.execute(table.update().where(table.c.id == db.bindparam('target')).values(
+                    upvotes=table.c.upvotes + db.bindparam('up'),
+                    downvotes=table.c.downvotes + db.bindparam('down'),
+                    score=table.c.score + db.bindparam('up') - db.bindparam('down'),
+                ), params)
+        post_ids = [content_id for (kind, content_id), (up, down) in counts.items() if kind == 'post' and (up or down)]
+        if post_ids:
+            Post.refresh_ranks(post_ids, session)
+        return set(counts)
+
+
+class HighWater(db.Model):
+    '''The highest sequence number applied from each origin node, committed in the
+       same transaction as the changes, so a snapshot carries them too'''
+    origin = db.Column(db.String(64), primary_key=True)  # "host:port" of the node that made the writes
+    seq = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def load(session=db.session):
+        return dict(session.execute(db.select(HighWater.origin, HighWater.seq)).all())
+
+    @staticmethod
+    def save(marks, session=db.session):
+        '''Store {origin: seq} high-water marks; the caller commits'''
+        if marks:
+            session.execute(HighWater.__table__.insert().prefix_with('OR REPLACE'),
+                               [{'origin': origin, 'seq': seq} for origin, seq in marks.items()])
+
+
+def migrate_schema():
+    '''Bring a database made by an older version up to date: db.create_all() only
+       creates missing tables, so add the columns and indexes the existing ones lack.
+       Safe to run on every start. Vote counters and rankings are computed for
+       columns that were just added.'''
+    inspector = db.inspect(db.engine)
+    added = set()
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(db.engine.dialect)}'
+            if column.server_default is not None:
+                # SQLite only adds a NOT NULL column that has a default
+                ddl += f"{'' if column.nullable else ' NOT NULL'} DEFAULT {column.server_default.arg}"
+            db.session.execute(db.text(ddl))
+            added.add(column.name)
+        for index in table.indexes:
+            index.create(db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+    if added & {'upvotes', 'downvotes', 'score'}:
+        recount_votes()
+    elif added & {'hot', 'controversy'}:
+        Post.refresh_ranks()
+        db.session.commit()
+
+
+def recount_votes():
+    '''Recompute every post and comment vote counter, and the post rankings, from the Vote table'''
+    for model, key in ((Post, Vote.post_id), (Comment, Vote.comment_id)):
+        up = db.select(db.func.count(Vote.id)).where(key == model.id, Vote.is_upvote == True).scalar_subquery()
+        down = db.select(db.func.count(Vote.id)).where(key == model.id, Vote.is_upvote == False).scalar_subquery()
+        db.session.execute(db.update(model).values(upvotes=up, downvotes=down, score=up - down))
+    Post.refresh_ranks()
+    db.session.commit()
@@ -13,23 +13,57 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rp2psync.proto\"\x07\n\x05\x45mpty\".\n\nPeerUpdate\x12\x13\n\x04peer\x18\x01 \x01(\x0b\x32\x05.Peer\x12\x0b\n\x03\x61\x64\x64\x18\x02 \x01(\x08\" \n\x08PeerList\x12\x14\n\x05peers\x18\x01 \x03(\x0b\x32\x05.Peer\"\"\n\x04Peer\x12\x0c\n\x04host\x18\x01 \x01(\t\x12\x0c\n\x04port\x18\x02 \x01(\t\"5\n\x0f\x44\x61tabaseCommand\x12\x11\n\ttimestamp\x18\x01 \x01(\x05\x12\x0f\n\x07\x63ommand\x18\x02 \x01(\t2\xef\x01\n\x07P2PSync\x12\'\n\x0ePeerListUpdate\x12\x0b.PeerUpdate\x1a\x06.Empty\"\x00\x12.\n\x0eListenCommands\x12\x06.Empty\x1a\x10.DatabaseCommand\"\x00\x30\x01\x12\x1a\n\x07\x43onnect\x12\x05.Peer\x1a\x06.Empty\"\x00\x12\x1d\n\tHeartbeat\x12\x06.Empty\x1a\x06.Empty\"\x00\x12)\n\x0bSendCommand\x12\x10.DatabaseCommand\x1a\x06.Empty\"\x00\x12%\n\x0fRequestPeerList\x12\x05.Peer\x1a\t.PeerList\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rp2psync.proto\"\x07\n\x05\x45mpty\"?\n\nPeerUpdate\x12\x13\n\x04peer\x18\x01 \x01(\x0b\x32\x05.Peer\x12\x0b\n\x03\x61\x64\x64\x18\x02 \x01(\x08\x12\x0f\n\x07version\x18\x03 \x01(\x03\" \n\x08PeerList\x12\x14\n\x05peers\x18\x01 \x03(\x0b\x32\x05.Peer\"\"\n\x04Peer\x12\x0c\n\x04host\x18\x01 \x01(\t\x12\x0c\n\x04port\x18\x02 \x01(\t\"s\n\x0f\x44\x61tabaseCommand\x12\x11\n\ttimestamp\x18\x01 \x01(\x05\x12\x1d\n\x06\x63hange\x18\x03 \x01(\x0b\x32\r.ChangeRecord\x12\x0e\n\x06origin\x18\x04 \x01(\t\x12\x0b\n\x03seq\x18\x05 \x01(\x03\x12\x0b\n\x03hlc\x18\x06 \x01(\x03J\x04\x08\x02\x10\x03\"\xf3\x01\n\x0c\x43hangeRecord\x12\"\n\x0binsert_user\x18\x01 \x01(\x0b\x32\x0b.UserRecordH\x00\x12\"\n\x0binsert_post\x18\x02 \x01(\x0b\x32\x0b.PostRecordH\x00\x12(\n\x0einsert_comment\x18\x03 \x01(\x0b\x32\x0e.CommentRecordH\x00\x12\x1f\n\x08put_vote\x18\x04 \x01(\x0b\x32\x0b.VoteRecordH\x00\x12\x15\n\x0b\x64\x65lete_vote\x18\x05 \x01(\x03H\x00\x12\x15\n\x0b\x64\x65lete_post\x18\x06 \x01(\x03H\x00\x12\x18\n\x0e\x64\x65lete_comment\x18\x07 \x01(\x03H\x00\x42\x08\n\x06\x63hange\"W\n\nUserRecord\x12\n\n\x02id\x18\x01 \x01(\x03\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x15\n\rpassword_hash\x18\x03 \x01(\t\x12\x14\n\x0c\x64\x61te_created\x18\x04 \x01(\x03\"\x84\x01\n\nPostRecord\x12\n\n\x02id\x18\x01 \x01(\x03\x12\r\n\x05title\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\x12\x11\n\tauthor_id\x18\x04 \x01(\x03\x12\x11\n\tanonymous\x18\x05 \x01(\x08\x12\x13\n\x0b\x64\x61te_posted\x18\x06 \x01(\x03\x12\x0f\n\x07\x64\x65leted\x18\x07 \x01(\x08\"\xaf\x01\n\rCommentRecord\x12\n\n\x02id\x18\x01 \x01(\x03\x12\x0f\n\x07post_id\x18\x02 \x01(\x03\x12\x11\n\tauthor_id\x18\x03 \x01(\x03\x12\x0f\n\x07\x63ontent\x18\x04 \x01(\t\x12\x11\n\tanonymous\x18\x05 \x01(\x08\x12\x13\n\x0b\x64\x61te_posted\x18\x06 \x01(\x03\x12\x16\n\tparent_id\x18\x07 \x01(\x03H\x00\x88\x01\x01\x12\x0f\n\x07\x64\x65leted\x18\x08 \x01(\x08\x42\x0c\n\n_parent_id\"a\n\nVoteRecord\x12\n\n\x02id\x18\x01 \x01(\x03\x12\x0f\n\x07user_id\x18\x02 \x01(\x03\x12\x0f\n\x07post_id\x18\x03 \x01(\x03\x12\x12\n\ncomment_id\x18\x04 \x01(\x03\x12\x11\n\tis_upvote\x18\x05 \x01(\x08\"B\n\x0c\x43ommandBatch\x12\"\n\x08\x63ommands\x18\x01 \x03(\x0b\x32\x10.DatabaseCommand\x12\x0e\n\x06sender\x18\x02 \x01(\t\"z\n\rCommandCursor\x12\x31\n\nhigh_water\x18\x02 \x03(\x0b\x32\x1d.CommandCursor.HighWaterEntry\x1a\x30\n\x0eHighWaterEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x03:\x02\x38\x01J\x04\x08\x01\x10\x02\"v\n\x06\x44igest\x12*\n\nhigh_water\x18\x01 \x03(\x0b\x32\x16.Digest.HighWaterEntry\x12\x0e\n\x06sender\x18\x02 \x01(\t\x1a\x30\n\x0eHighWaterEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x03:\x02\x38\x01\"=\n\rSnapshotChunk\x12\x0e\n\x06\x63ommit\x18\x01 \x01(\x05\x12\x0c\n\x04\x64\x61ta\x18\x02 \x01(\x0c\x12\x0e\n\x06sha256\x18\x03 \x01(\t\"\xcd\x01\n\nNodeStatus\x12\x0f\n\x07node_id\x18\x01 \x01(\t\x12\x16\n\x0e\x63ommit_counter\x18\x02 \x01(\x03\x12.\n\nhigh_water\x18\x03 \x03(\x0b\x32\x1a.NodeStatus.HighWaterEntry\x12\x18\n\x10\x63ommit_log_bytes\x18\x04 \x01(\x03\x12\x1a\n\x05peers\x18\x05 \x03(\x0b\x32\x0b.PeerStatus\x1a\x30\n\x0eHighWaterEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x03:\x02\x38\x01\"\xae\x01\n\nPeerStatus\x12\x0f\n\x07\x61\x64\x64ress\x18\x01 \x01(\t\x12\r\n\x05state\x18\x02 \x01(\t\x12\x13\n\x0bqueue_depth\x18\x03 \x01(\x03\x12\x13\n\x0blag_seconds\x18\x04 \x01(\x01\x12\x13\n\x06\x62\x65hind\x18\x05 \x01(\x03H\x00\x88\x01\x01\x12\x1f\n\x12seconds_since_seen\x18\x06 \x01(\x01H\x01\x88\x01\x01\x42\t\n\x07_behindB\x15\n\x13_seconds_since_seen2\x92\x03\n\x07P2PSync\x12\'\n\x0ePeerListUpdate\x12\x0b.PeerUpdate\x1a\x06.Empty\"\x00\x12\x33\n\x0eListenCommands\x12\x0e.CommandCursor\x1a\r.CommandBatch\"\x00\x30\x01\x12,\n\x0eListenSnapshot\x12\x06.Empty\x1a\x0e.SnapshotChunk\"\x00\x30\x01\x12\x1a\n\x07\x43onnect\x12\x05.Peer\x1a\x06.Empty\"\x00\x12\x1d\n\tHeartbeat\x12\x06.Empty\x1a\x06.Empty\"\x00\x12)\n\x0bSendCommand\x12\x10.DatabaseCommand\x1a\x06.Empty\"\x00\x12\'\n\x0cSendCommands\x12\r.CommandBatch\x1a\x06.Empty\"\x00\x12%\n\x0fRequestPeerList\x12\x05.Peer\x1a\t.PeerList\"\x00\x12$\n\x0e\x45xchangeDigest\x12\x07.Digest\x1a\x07.Digest\"\x00\x12\x1f\n\x06Status\x12\x06.Empty\x1a\x0b.NodeStatus\"\x00\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'p2psync_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
+  _COMMANDCURSOR_HIGHWATERENTRY._options = None
+  _COMMANDCURSOR_HIGHWATERENTRY._serialized_options = b'8\001'
+  _DIGEST_HIGHWATERENTRY._options = None
+  _DIGEST_HIGHWATERENTRY._serialized_options = b'8\001'
+  _NODESTATUS_HIGHWATERENTRY._options = None
+  _NODESTATUS_HIGHWATERENTRY._serialized_options = b'8\001'
   _EMPTY._serialized_start=17
   _EMPTY._serialized_end=24
   _PEERUPDATE._serialized_start=26
-  _PEERUPDATE._serialized_end=72
-  _PEERLIST._serialized_start=74
-  _PEERLIST._serialized_end=106
-  _PEER._serialized_start=108
-  _PEER._serialized_end=142
-  _DATABASECOMMAND._serialized_start=144
-  _DATABASECOMMAND._serialized_end=197
-  _P2PSYNC._serialized_start=200
-  _P2PSYNC._serialized_end=439
+  _PEERUPDATE._serialized_end=89
+  _PEERLIST._serialized_start=91
+  _PEERLIST._serialized_end=123
+  _PEER._serialized_start=125
+  _PEER._serialized_end=159
+  _DATABASECOMMAND._serialized_start=161
+  _DATABASECOMMAND._serialized_end=276
+  _CHANGERECORD._serialized_start=279
+  _CHANGERECORD._serialized_end=522
+  _USERRECORD._serialized_start=524
+  _USERRECORD._serialized_end=611
+  _POSTRECORD._serialized_start=614
+  _POSTRECORD._serialized_end=746
+  _COMMENTRECORD._serialized_start=749
+  _COMMENTRECORD._serialized_end=924
+  _VOTERECORD._serialized_start=926
+  _VOTERECORD._serialized_end=1023
+  _COMMANDBATCH._serialized_start=1025
+  _COMMANDBATCH._serialized_end=1091
+  _COMMANDCURSOR._serialized_start=1093
+  _COMMANDCURSOR._serialized_end=1215
+  _COMMANDCURSOR_HIGHWATERENTRY._serialized_start=1161
+  _COMMANDCURSOR_HIGHWATERENTRY._serialized_end=1209
+  _DIGEST._serialized_start=1217
+  _DIGEST._serialized_end=1335
+  _DIGEST_HIGHWATERENTRY._serialized_start=1161
+  _DIGEST_HIGHWATERENTRY._serialized_end=1209
+  _SNAPSHOTCHUNK._serialized_start=1337
+  _SNAPSHOTCHUNK._serialized_end=1398
+  _NODESTATUS._serialized_start=1401
+  _NODESTATUS._serialized_end=1606
+  _NODESTATUS_HIGHWATERENTRY._serialized_start=1161
+  _NODESTATUS_HIGHWATERENTRY._serialized_end=1209
+  _PEERSTATUS._serialized_start=1609
+  _PEERSTATUS._serialized_end=1783
+  _P2PSYNC._serialized_start=1786
+  _P2PSYNC._serialized_end=2188
 # @@protoc_insertion_point(module_scope)
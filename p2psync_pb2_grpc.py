@@ -21,8 +21,13 @@ class P2PSyncStub(object):
                 )
         self.ListenCommands = channel.unary_stream(
                 '/P2PSync/ListenCommands',
+                request_serializer=p2psync__pb2.CommandCursor.SerializeToString,
+                response_deserializer=p2psync__pb2.CommandBatch.FromString,
+                )
+        self.ListenSnapshot = channel.unary_stream(
+                '/P2PSync/ListenSnapshot',
                 request_serializer=p2psync__pb2.Empty.SerializeToString,
-                response_deserializer=p2psync__pb2.DatabaseCommand.FromString,
+                response_deserializer=p2psync__pb2.SnapshotChunk.FromString,
                 )
         self.Connect = channel.unary_unary(
                 '/P2PSync/Connect',
@@ -39,11 +44,26 @@ class P2PSyncStub(object):
                 request_serializer=p2psync__pb2.DatabaseCommand.SerializeToString,
                 response_deserializer=p2psync__pb2.Empty.FromString,
                 )
+        self.SendCommands = channel.unary_unary(
+                '/P2PSync/SendCommands',
+                request_serializer=p2psync__pb2.CommandBatch.SerializeToString,
+                response_deserializer=p2psync__pb2.Empty.FromString,
+                )
         self.RequestPeerList = channel.unary_unary(
                 '/P2PSync/RequestPeerList',
                 request_serializer=p2psync__pb2.Peer.SerializeToString,
                 response_deserializer=p2psync__pb2.PeerList.FromString,
                 )
+        self.ExchangeDigest = channel.unary_unary(
+                '/P2PSync/ExchangeDigest',
+                request_serializer=p2psync__pb2.Digest.SerializeToString,
+                response_deserializer=p2psync__pb2.Digest.FromString,
+                )
+        self.Status = channel.unary_unary(
+                '/P2PSync/Status',
+                request_serializer=p2psync__pb2.Empty.SerializeToString,
+                response_deserializer=p2psync__pb2.NodeStatus.FromString,
+                )
 
 
 class P2PSyncServicer(object):
@@ -61,6 +81,12 @@ class P2PSyncServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListenSnapshot(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def Connect(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -79,12 +105,30 @@ class P2PSyncServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendCommands(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def RequestPeerList(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ExchangeDigest(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Status(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_P2PSyncServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -95,8 +139,13 @@ def add_P2PSyncServicer_to_server(servicer, server):
             ),
             'ListenCommands': grpc.unary_stream_rpc_method_handler(
                     servicer.ListenCommands,
+                    request_deserializer=p2psync__pb2.CommandCursor.FromString,
+                    response_serializer=p2psync__pb2.CommandBatch.SerializeToString,
+            ),
+            'ListenSnapshot': grpc.unary_stream_rpc_method_handler(
+                    servicer.ListenSnapshot,
                     request_deserializer=p2psync__pb2.Empty.FromString,
-                    response_serializer=p2psync__pb2.DatabaseCommand.SerializeToString,
+                    response_serializer=p2psync__pb2.SnapshotChunk.SerializeToString,
             ),
             'Connect': grpc.unary_unary_rpc_method_handler(
                     servicer.Connect,
@@ -113,11 +162,26 @@ def add_P2PSyncServicer_to_server(servicer, server):
                     request_deserializer=p2psync__pb2.DatabaseCommand.FromString,
                     response_serializer=p2psync__pb2.Empty.SerializeToString,
             ),
+            'SendCommands': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendCommands,
+                    request_deserializer=p2psync__pb2.CommandBatch.FromString,
+                    response_serializer=p2psync__pb2.Empty.SerializeToString,
+            ),
             'RequestPeerList': grpc.unary_unary_rpc_method_handler(
                     servicer.RequestPeerList,
                     request_deserializer=p2psync__pb2.Peer.FromString,
                     response_serializer=p2psync__pb2.PeerList.SerializeToString,
             ),
+            'ExchangeDigest': grpc.unary_unary_rpc_method_handler(
+                    servicer.ExchangeDigest,
+                    request_deserializer=p2psync__pb2.Digest.FromString,
+                    response_serializer=p2psync__pb2.Digest.SerializeToString,
+            ),
+            'Status': grpc.unary_unary_rpc_method_handler(
+                    servicer.Status,
+                    request_deserializer=p2psync__pb2.Empty.FromString,
+                    response_serializer=p2psync__pb2.NodeStatus.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'P2PSync', rpc_method_handlers)
@@ -157,8 +221,25 @@ class P2PSync(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_stream(request, target, '/P2PSync/ListenCommands',
+            p2psync__pb2.CommandCursor.SerializeToString,
+            p2psync__pb2.CommandBatch.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ListenSnapshot(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/P2PSync/ListenSnapshot',
             p2psync__pb2.Empty.SerializeToString,
-            p2psync__pb2.DatabaseCommand.FromString,
+            p2psync__pb2.SnapshotChunk.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
@@ -213,6 +294,23 @@ class P2PSync(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendCommands(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/P2PSync/SendCommands',
+            p2psync__pb2.CommandBatch.SerializeToString,
+            p2psync__pb2.Empty.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def RequestPeerList(request,
             target,
@@ -229,3 +327,37 @@ class P2PSync(object):
             p2psync__pb2.PeerList.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ExchangeDigest(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/P2PSync/ExchangeDigest',
+            p2psync__pb2.Digest.SerializeToString,
+            p2psync__pb2.Digest.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Status(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/P2PSync/Status',
+            p2psync__pb2.Empty.SerializeToString,
+            p2psync__pb2.NodeStatus.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import pbkdf2_sha256
+
+from config import PASSWORD_QUEUE_LIMIT, PASSWORD_ROUNDS, PASSWORD_SALT_SIZE, PASSWORD_TIMEOUT, PASSWORD_WORKERS
+
+
+class Overloaded(Exception):
+    '''Too many passwords are already waiting to be hashed; the user should try again shortly'''
+
+
+def hash_password(password, rounds, salt_size):
+    return pbkdf2_sha256.using(rounds=rounds, salt_size=salt_size).hash(password)
+
+
+def verify_password(password, password_hash, rounds, salt_size):
+    '''Returns (whether the password matches, a new hash if the stored one was made
+       with other parameters than `rounds` and `salt_size`, else None)'''
+    if not pbkdf2_sha256.verify(password, password_hash):
+        return False, None
+    stored = pbkdf2_sha256.from_string(password_hash)
+    if stored.rounds != rounds or len(stored.salt) != salt_size:
+        return True, hash_password(password, rounds, salt_size)
+    return True, None
+
+
+def watch_parent(parent):
+    '''Run in each worker process: exit once the process that forked it is gone, even
+       if it was killed and had no chance to shut the pool down'''
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class PasswordHasher:
+    '''PBKDF2 runs for a tenth of a second or so per password, so it is done in a pool
+       of worker processes rather than on the request threads. At most PASSWORD_WORKERS
+       hashes run at once and PASSWORD_QUEUE_LIMIT more may wait; beyond that, requests
+       are turned away with Overloaded at once instead of queueing without bound.'''
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.pool = None
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def start(self):
+        '''Fork the worker processes. Call it before starting any threads (the gRPC
+           server, peer channels), which a forked process would not get a working copy of.'''
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=watch_parent, initargs=(os.getpid(),))
+                # Forks every worker now, rather than on the first login
+                self.pool.submit(int).result()
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise Overloaded()
+        try:
+            self.start()
+            future = self.pool.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result(timeout=PASSWORD_TIMEOUT)
+
+    def hash(self, password):
+        return self.run(hash_password, password, PASSWORD_ROUNDS, PASSWORD_SALT_SIZE)
+
+    def verify(self, password, password_hash):
+        '''Returns (matches, upgraded hash or None), as verify_password'''
+        return self.run(verify_password, password, password_hash, PASSWORD_ROUNDS, PASSWORD_SALT_SIZE)
+
+
+hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+
+from cache import fragments, users
+from models import Comment, Post, User, Vote, db, hot_rank
+
+import p2psync_pb2 as pb2
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_micros(date):
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+# Change records for the writes a node replicates
+
+def user_record(user):
+    return pb2.ChangeRecord(insert_user=pb2.UserRecord(
+        id=user.id, username=user.username, password_hash=user.password_hash,
+        date_created=to_micros(user.date_created)))
+
+
+def post_record(post):
+    return pb2.ChangeRecord(insert_post=pb2.PostRecord(
+        id=post.id, title=post.title, content=post.content, author_id=post.author_id,
+        anonymous=bool(post.anonymous), date_posted=to_micros(post.date_posted), deleted=bool(post.deleted)))
+
+
+def comment_record(comment):
+    return pb2.ChangeRecord(insert_comment=pb2.CommentRecord(
+        id=comment.id, post_id=comment.post_id, author_id=comment.author_id, content=comment.content,
+        anonymous=bool(comment.anonymous), date_posted=to_micros(comment.date_posted),
+        parent_id=comment.parent_id, deleted=bool(comment.deleted)))
+
+
+def vote_record(vote):
+    return pb2.ChangeRecord(put_vote=pb2.VoteRecord(
+        id=vote.id, user_id=vote.user_id, post_id=vote.post_id, comment_id=vote.comment_id,
+        is_upvote=vote.is_upvote))
+
+
+def delete_vote_record(vote):
+    return pb2.ChangeRecord(delete_vote=vote.id)
+
+
+def delete_post_record(post):
+    return pb2.ChangeRecord(delete_post=post.id)
+
+
+def delete_comment_record(comment):
+    return pb2.ChangeRecord(delete_comment=comment.id)
+
+
+# Applying change records from peers. Inserts use INSERT OR IGNORE, so replaying
+# a record the database already holds (e.g. from a snapshot) is harmless.
+
+def user_row(record):
+    return {'id': record.id, 'username': record.username, 'password_hash': record.password_hash,
+            'date_created': from_micros(record.date_created)}
+
+
+def post_row(record):
+    date_posted = from_micros(record.date_posted)
+    return {'id': record.id, 'title': record.title, 'content': record.content, 'author_id': record.author_id,
+            'anonymous': record.anonymous, 'date_posted': date_posted, 'deleted': record.deleted,
+            'upvotes': 0, 'downvotes': 0, 'score': 0, 'hot': hot_rank(0, date_posted), 'controversy': 0}
+
+
+def comment_row(record):
+    return {'id': record.id, 'post_id': record.post_id, 'author_id': record.author_id, 'content': record.content,
+            'anonymous': record.anonymous, 'date_posted': from_micros(record.date_posted),
+            'parent_id': record.parent_id if record.HasField('parent_id') else None, 'deleted': record.deleted,
+            'upvotes': 0, 'downvotes': 0, 'score': 0}
+
+
+# Change kind -> (table, row builder) for the kinds applied as bulk inserts
+INSERTS = {
+    'insert_user': (User.__table__, user_row),
+    'insert_post': (Post.__table__, post_row),
+    'insert_comment': (Comment.__table__, comment_row),
+}
+
+
+def apply_early_arrivals(kind, ids, session, changed, counts):
+    '''Catch up newly inserted rows with what reached us before them: writes from
+       different nodes are applied in any order, so a vote can arrive before the post
+       or comment it is on, and a post or comment before the user who wrote it'''
+    if kind == 'insert_user':
+        changed.update(('user', user_id) for user_id in ids)
+        # Their fragments were cached without an author name
+        for model in (Post, Comment):
+            changed.update((model.__tablename__, row_id) for row_id in
+                           session.scalars(db.select(model.id).where(model.author_id.in_(ids))))
+    else:
+        # Votes on posts carry comment_id=-1 and votes on comments post_id=-1, so neither matches the other
+        key = Vote.post_id if kind == 'insert_post' else Vote.comment_id
+        votes = set(session.scalars(db.select(Vote.id).where(key.in_(ids))))
+        if votes:
+            Vote.count_rows(votes, 1, counts, session)
+
+
+def vote_row(record):
+    return {'id': record.id, 'user_id': record.user_id, 'post_id': record.post_id,
+            'comment_id': record.comment_id, 'is_upvote': record.is_upvote}
+
+
+def apply_inserts(kind, records, session, changed, counts):
+    table, row = INSERTS[kind]
+    ids = {record.id for record in records}
+    new = ids - set(session.scalars(db.select(table.c.id).where(table.c.id.in_(ids))))
+    session.execute(table.insert().prefix_with('OR IGNORE'), [row(record) for record in records])
+    if new:
+        apply_early_arrivals(kind, new, session, changed, counts)
+
+
+def apply_votes(puts, deletes, session, counts):
+    '''Write and delete vote rows, retracting what the rows counted for before and
+       counting what they are now'''
+    vote = Vote.__table__
+    vote_ids = {record.id for record in puts} | set(deletes)
+    Vote.count_rows(vote_ids, -1, counts, session)
+    if puts:
+        # The last write to a vote id wins, as it would one by one
+        session.execute(vote.insert().prefix_with('OR REPLACE'), [vote_row(record) for record in puts])
+    if deletes:
+        session.execute(vote.delete().where(vote.c.id.in_(deletes)))
+    Vote.count_rows(vote_ids, 1, counts, session)
+
+
+def apply_deletes(model, records, session, changed):
+    table = model.__table__
+    session.execute(table.update().where(table.c.id.in_(records)).values(deleted=True))
+    changed.update((model.__tablename__, record) for record in records)
+
+
+# Every kind of change record, in the order apply_changes() applies them
+KINDS = ('insert_user', 'insert_post', 'insert_comment', 'put_vote', 'delete_vote', 'delete_post', 'delete_comment')
+
+
+def apply_changes(changes, session=db.session):
+    '''Apply change records in the session's current transaction; the caller commits,
+       then passes the returned set of changed rows to invalidate_cached().
+       The records are grouped by kind across the whole batch, and each kind goes to
+       the database as one parameterized executemany (or IN query), rather than a
+       statement per record. Rows are inserted before the votes on them and marked
+       deleted last, and the vote counters and rankings are updated once at the end.
+       Early arrivals are reconciled either way, and vote ids are never reused, so
+       this gives the same result as applying the records one by one.'''
+    groups = {kind: [] for kind in KINDS}
+    for change in changes:
+        kind = change.WhichOneof('change')
+        if kind not in groups:
+            raise ValueError(f'Unknown change record {kind}')
+        groups[kind].append(getattr(change, kind))
+
+    changed, counts = set(), {}
+    for kind in INSERTS:
+        if groups[kind]:
+            apply_inserts(kind, groups[kind], session, changed, counts)
+    if groups['put_vote'] or groups['delete_vote']:
+        apply_votes(groups['put_vote'], groups['delete_vote'], session, counts)
+    for kind, model in (('delete_post', Post), ('delete_comment', Comment)):
+        if groups[kind]:
+            apply_deletes(model, groups[kind], session, changed)
+    changed |= Vote.apply_counts(counts, session)
+    return changed
+
+
+def invalidate_cached(changed):
+    '''Drop the cached fragments and users of rows that apply_changes() changed. Only
+       call it once they are committed: a page rendered before then would read the old
+       rows and cache them under the new version.'''
+    for kind, row_id in changed:
+        if kind == 'user':
+            users.invalidate(row_id)
+        else:
+            fragments.invalidate(kind, row_id)
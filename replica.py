@@ -0,0 +1,99 @@
+import threading
+from collections import deque
+
+from config import APPLY_BATCH_SIZE, REPLICA_QUEUE_LIMIT
+from records import apply_changes, invalidate_cached
+from snapshot import copy_database
+
+
+class ReadReplica:
+    '''The read replica database (the 'slave' bind) that read-only pages are served
+       from, kept a copy of the primary by applying this node's commit stream to it:
+       every command appended to the commit log, written here or replicated from a
+       peer, is queued in log order and applied in batches by a background thread.
+       If the replica falls REPLICA_QUEUE_LIMIT commands behind, or a batch fails,
+       it is copied afresh from the primary.'''
+    def __init__(self, primary, engine, session, lock, last_commit):
+        self.primary, self.engine, self.session = primary, engine, session
+        self.lock = lock                # Held while commands are appended to the commit log
+        self.last_commit = last_commit  # Returns the newest commit number in the commit log
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.applied = 0     # Commit number the replica is up to date with
+        self.stale = False   # Set when the replica has to be copied from the primary again
+        self.rebuilds = 0
+        self.stopped = False
+        self.rebuild()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def rebuild(self):
+        '''Copy the primary over the replica, while no commands are being committed'''
+        with self.lock, self.condition:
+            copy_database(self.primary, self.engine)
+            self.queue.clear()
+            self.applied = self.last_commit()
+            self.stale = False
+            self.rebuilds += 1
+
+    def publish(self, commands):
+        '''Queue commands just appended to the commit log; the caller holds the lock'''
+        with self.condition:
+            if len(self.queue) + len(commands) > REPLICA_QUEUE_LIMIT:
+                self.queue.clear()
+                self.stale = True
+            else:
+                self.queue.extend(commands)
+            self.condition.notify()
+
+    def invalidate(self):
+        '''Have the replica copied from the primary again, e.g. after the primary was
+           replaced by a snapshot; the caller may hold the lock'''
+        with self.condition:
+            self.queue.clear()
+            self.stale = True
+            self.condition.notify()
+
+    def caught_up(self, commit):
+        '''Whether the replica has applied every commit up to `commit`'''
+        return not self.stale and self.applied >= commit
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stale and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), APPLY_BATCH_SIZE))]
+
+            if self.stale:
+                self.rebuild()
+                continue
+            session = self.session()
+            try:
+                changed = apply_changes([command.change for command in batch], session)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f'Read replica failed to apply commands, copying it from the primary again: {e}')
+                self.stale = True
+                continue
+            finally:
+                self.session.remove()
+            # Pages read from the replica may have cached its old rows since the primary invalidated them
+            invalidate_cached(changed)
+            with self.condition:
+                # If commands were dropped meanwhile, the replica is rebuilt instead
+                if not self.stale:
+                    self.applied = max(self.applied, batch[-1].timestamp)
+
+    def stats(self):
+        with self.condition:
+            return {'applied': self.applied, 'queued': len(self.queue), 'stale': self.stale,
+                    'rebuilds': self.rebuilds}
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+from collections import deque
+
+from channels import channels
+from config import (REPLICATION_BATCH_SIZE, REPLICATION_QUEUE_LIMIT, REPLICATION_RETRY_BASE,
+                    REPLICATION_RETRY_MAX, REPLICATION_RPC_TIMEOUT)
+from metrics import RPC_FAILURES, RPC_SECONDS
+
+import p2psync_pb2 as pb2
+import grpc
+
+
+class PeerSender:
+    '''Background worker that ships committed commands to one peer, in order.
+       Commands queued while a batch is in flight go out together in the next
+       SendCommands call; a failed batch is retried with exponential backoff.'''
+    def __init__(self, host, port, sender):
+        self.host, self.port = host, port
+        self.sender = sender  # Our own "host:port", so the peer knows where to fetch anything it is missing
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        # Replication progress, read by stats()
+        self.last_queued = 0        # Timestamp of the newest command queued
+        self.last_acked = 0         # Timestamp of the newest command the peer acknowledged
+        self.oldest_unacked = None  # time.time() when the oldest unacknowledged command was queued
+        self.dropped = 0            # Commands discarded because the queue was full
+        self.failures = 0           # Consecutive failed sends
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, command):
+        with self.condition:
+            if len(self.queue) >= REPLICATION_QUEUE_LIMIT:
+                # The peer is too far behind; it catches up through ListenCommands when it rejoins
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((command, time.time()))
+            self.last_queued = command.timestamp
+            if self.oldest_unacked is None:
+                self.oldest_unacked = time.time()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                batch = [self.queue[i] for i in range(min(len(self.queue), REPLICATION_BATCH_SIZE))]
+
+            peer, start = f'{self.host}:{self.port}', time.perf_counter()
+            try:
+                channels.stub(self.host, self.port).SendCommands(
+                    pb2.CommandBatch(commands=[command for command, _ in batch], sender=self.sender),
+                    timeout=REPLICATION_RPC_TIMEOUT)
+            except grpc.RpcError:
+                RPC_FAILURES.labels(peer, 'SendCommands').inc()
+                self.failures += 1
+                backoff = min(REPLICATION_RETRY_BASE * 2 ** (self.failures - 1), REPLICATION_RETRY_MAX)
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopped, timeout=backoff)
+                continue
+
+            RPC_SECONDS.labels(peer, 'SendCommands').observe(time.perf_counter() - start)
+            self.failures = 0
+            with self.condition:
+                # Commands may have been dropped from the front while the batch was in flight
+                sent = batch[-1][0].timestamp
+                while self.queue and self.queue[0][0].timestamp <= sent:
+                    self.queue.popleft()
+                self.last_acked = sent
+                self.oldest_unacked = self.queue[0][1] if self.queue else None
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.queue),
+                'lag_commits': self.last_queued - self.last_acked,
+                'lag_seconds': time.time() - self.oldest_unacked if self.oldest_unacked else 0.0,
+                'last_acked': self.last_acked,
+                'dropped': self.dropped,
+                'failures': self.failures,
+            }
+
+
+class Outbox:
+    '''Outbound replication queue: one PeerSender per peer, so a slow or dead
+       peer never holds up the request that produced a command'''
+    def __init__(self, sender):
+        self.sender = sender
+        self.senders = {}
+        self.lock = threading.Lock()
+
+    def publish(self, peers, commands, fanout=None, exclude=()):
+        '''Queue the commands for `fanout` peers of the list picked at random (all
+           of them if None), leaving out the "host:port" addresses in `exclude`.
+           Senders of peers that have left the list are stopped.'''
+        with self.lock:
+            current = {(p.host, p.port) for p in peers}
+            for key in list(self.senders):
+                if key not in current:
+                    self.senders.pop(key).stop()
+
+            targets = sorted(key for key in current if f'{key[0]}:{key[1]}' not in exclude)
+            if fanout is not None and fanout < len(targets):
+                targets = random.sample(targets, fanout)
+            for key in targets:
+                if key not in self.senders:
+                    self.senders[key] = PeerSender(*key, self.sender)
+                for command in commands:
+                    self.senders[key].enqueue(command)
+
+    def stats(self):
+        '''Queue depth and replication lag for each peer, keyed by "host:port"'''
+        with self.lock:
+            senders = dict(self.senders)
+        return {f'{host}:{port}': sender.stats() for (host, port), sender in senders.items()}
+
+    def stop(self):
+        with self.lock:
+            for sender in self.senders.values():
+                sender.stop()
+            self.senders.clear()
@@ -0,0 +1,30 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from config import REPLICATION_DB_POOL_SIZE, REPLICATION_DB_POOL_TIMEOUT
+
+
+def enable_wal(dbapi_connection, connection_record):
+    '''Write-ahead logging lets web requests read while replicated commands are being
+       written. With synchronous=NORMAL a power cut can lose the last few transactions
+       but not corrupt the database; their high-water marks go with them, so the
+       commands are fetched again from peers.'''
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def open_replication_db(engine):
+    '''Returns (engine, scoped session factory) for the replication server: the same
+       database as the web app's engine, but a connection pool and thread-local
+       sessions of its own, so replicated writes never share a session with a web
+       request. An in-memory database lives in a single connection, so for one the
+       web app's engine is shared instead.'''
+    if engine.url.database in (None, '', ':memory:'):
+        replication_engine = engine
+    else:
+        replication_engine = create_engine(engine.url, pool_size=REPLICATION_DB_POOL_SIZE, max_overflow=0,
+                                           pool_timeout=REPLICATION_DB_POOL_TIMEOUT)
+        event.listen(replication_engine, 'connect', enable_wal)
+    return replication_engine, scoped_session(sessionmaker(bind=replication_engine))
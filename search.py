@@ -0,0 +1,77 @@
+from sqlalchemy import column, literal_column, table, text
+
+from models import Post, db
+
+# FTS5 index over post titles and content. It is an external-content table: it
+# stores only the index and reads the text back from the post table. Triggers keep
+# it in sync, so posts written locally and commands replicated from peers are
+# indexed in the same transaction that writes them.
+SEARCH_TABLE = 'post_search'
+
+SEARCH_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}
+        USING fts5(title, content, content='post', content_rowid='id')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON post BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON post BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF title, content ON post BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO {SEARCH_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+]
+
+post_search = table(SEARCH_TABLE, column('rowid'))
+
+# Title matches count double when ranking
+RANK = literal_column(f'bm25({SEARCH_TABLE}, 2.0, 1.0)')
+
+
+def create_search_index():
+    '''Create the search index and its triggers if missing, indexing any existing posts'''
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"), {'name': SEARCH_TABLE}
+    ).first()
+    for statement in SEARCH_SCHEMA:
+        db.session.execute(text(statement))
+    db.session.commit()
+    if not exists:
+        rebuild_search_index()
+
+
+def rebuild_search_index():
+    '''Re-index every post from scratch'''
+    db.session.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def match_expression(query):
+    '''Turn free text into an FTS5 query: every word must appear, as a word prefix.
+       Quoting each word keeps user input from being parsed as FTS5 syntax.'''
+    words = ['"{}"*'.format(word.replace('"', '""')) for word in query.split()]
+    return ' '.join(words)
+
+
+def search_posts(query, after, per_page):
+    '''Returns (posts, next_cursor) for a page of non-deleted posts matching the query,
+       best match first. The cursor is the offset of the next page.'''
+    expression = match_expression(query)
+    if not expression:
+        return [], None
+    try:
+        offset = max(int(after), 0) if after else 0
+    except ValueError:
+        offset = 0
+
+    posts = Post.query.join(post_search, post_search.c.rowid == Post.id) \
+        .filter(literal_column(SEARCH_TABLE).op('MATCH')(expression)) \
+        .filter(Post.deleted == False) \
+        .order_by(RANK, Post.date_posted.desc()) \
+        .offset(offset).limit(per_page + 1).all()
+    if len(posts) > per_page:
+        return posts[:per_page], str(offset + per_page)
+    return posts, None
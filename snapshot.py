@@ -0,0 +1,90 @@
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+
+from config import SNAPSHOT_CHUNK_SIZE
+
+
+def snapshot_name(prefix, commit):
+    return f'{prefix}_{commit}.db'
+
+
+def latest_snapshot(prefix):
+    '''Returns (filename, commit) of the newest snapshot with this prefix, or (None, 0)'''
+    newest = (None, 0)
+    for filename in glob.glob(f'{glob.escape(prefix)}_*.db'):
+        match = re.search(r'_(\d+)\.db$', filename)
+        if match and int(match.group(1)) > newest[1]:
+            newest = (filename, int(match.group(1)))
+    return newest
+
+
+def remove_snapshots(prefix, keep):
+    '''Delete every snapshot with this prefix except the file `keep`'''
+    for filename in glob.glob(f'{glob.escape(prefix)}_*.db'):
+        if filename != keep:
+            os.remove(filename)
+
+
+def take_snapshot(engine, filename):
+    '''Copy the database behind the engine into a new file, atomically'''
+    temporary = filename + '.tmp'
+    raw = engine.raw_connection()
+    try:
+        target = sqlite3.connect(temporary)
+        with target:
+            raw.dbapi_connection.backup(target)
+        target.close()
+    finally:
+        raw.close()
+    os.replace(temporary, filename)
+
+
+def restore_snapshot(engine, filename):
+    '''Overwrite the database behind the engine with the snapshot file'''
+    source = sqlite3.connect(filename)
+    raw = engine.raw_connection()
+    try:
+        source.backup(raw.dbapi_connection)
+    finally:
+        raw.close()
+        source.close()
+    engine.dispose()  # Pooled connections may hold pages of the old database
+
+
+def copy_database(source, target):
+    '''Overwrite the database behind engine `target` with the one behind engine `source`'''
+    raw_source, raw_target = source.raw_connection(), target.raw_connection()
+    try:
+        raw_source.dbapi_connection.backup(raw_target.dbapi_connection)
+    finally:
+        raw_target.close()
+        raw_source.close()
+
+
+def checksum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(SNAPSHOT_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_chunks(filename):
+    with open(filename, 'rb') as f:
+        yield from iter(lambda: f.read(SNAPSHOT_CHUNK_SIZE), b'')
+
+
+def snapshot_high_water(filename):
+    '''The {origin: seq} high-water marks stored in a snapshot'''
+    if filename is None:
+        return {}
+    connection = sqlite3.connect(filename)
+    try:
+        return dict(connection.execute('SELECT origin, seq FROM high_water'))
+    except sqlite3.OperationalError:
+        return {}  # Taken before high-water marks were stored
+    finally:
+        connection.close()